@@ -0,0 +1,385 @@
+"""In-process load test for the FriendSnap API.
+
+Starts the app against a throwaway database, replaces the GPT-4o call with a
+deterministic stub, seeds a synthetic population and drives concurrent
+scenarios through the ASGI app, then prints p50/p95/p99 latency and
+requests per second per endpoint.
+
+    python benchmark.py                                  # in-memory Mongo stand-in
+    python benchmark.py --mongo-url mongodb://localhost:27017
+    python benchmark.py --json results.json              # save results
+    python benchmark.py --baseline results.json          # exit 1 on p95 regressions
+
+The in-memory stand-in (mongomock-motor) measures the app's own overhead;
+use a local mongod to see real query costs. With --mongo-url the database
+named by --db-name is dropped before seeding. After seeding, the interest
+index, timelines and moderation queue are checked, and the run stops if
+the seeded state is not what the real code paths would produce.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+CATEGORIES = ["animals", "nature", "food", "sports", "music", "art", "colors", "objects", "places"]
+TAGS = {
+    "animals": ["dog", "cat", "bird", "horse", "fish"],
+    "nature": ["tree", "flower", "beach", "mountain", "sky"],
+    "food": ["pizza", "cake", "fruit", "ice cream", "pasta"],
+    "sports": ["football", "basketball", "swimming", "bike", "tennis"],
+    "music": ["guitar", "piano", "drums", "concert", "singing"],
+    "art": ["painting", "drawing", "clay", "colors", "crafts"],
+    "colors": ["red", "blue", "green", "yellow", "rainbow"],
+    "objects": ["car", "train", "toy", "book", "lamp"],
+    "places": ["park", "city", "zoo", "museum", "home"],
+}
+
+# Relative weight of each scenario in the mix
+SCENARIOS = {
+    "feed": 30,
+    "chat_poll": 30,
+    "send_message": 10,
+    "conversations": 10,
+    "suggestions": 10,
+    "upload": 5,
+    "friends": 5,
+}
+
+
+def stub_analysis(image_base64: str) -> dict:
+    """Same image, same answer: category and tags picked from the image hash"""
+    digest = hashlib.sha256(image_base64.encode("ascii")).digest()
+    category = CATEGORIES[digest[0] % len(CATEGORIES)]
+    tags = [TAGS[category][b % len(TAGS[category])] for b in digest[1:4]]
+    return {
+        "contains_people": False,
+        "is_famous_person": False,
+        "category": category,
+        "tags": list(dict.fromkeys(tags)),
+        "description": f"A picture of {tags[0]}",
+    }
+
+
+def random_png(rng: random.Random, size: int = 64) -> bytes:
+    from PIL import Image
+    image = Image.frombytes("RGB", (size, size), bytes(rng.getrandbits(8) for _ in range(size * size * 3)))
+    out = io.BytesIO()
+    image.save(out, format="PNG")
+    return out.getvalue()
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, label: str, seconds: float, ok: bool) -> None:
+        self.latencies[label].append(seconds)
+        if not ok:
+            self.errors[label] += 1
+
+    def summary(self, duration: float) -> dict:
+        results = {}
+        for label, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            results[label] = {
+                "requests": len(values),
+                "errors": self.errors[label],
+                "rps": round(len(values) / duration, 2),
+                "p50_ms": round(percentile(values, 50) * 1000, 2),
+                "p95_ms": round(percentile(values, 95) * 1000, 2),
+                "p99_ms": round(percentile(values, 99) * 1000, 2),
+            }
+        return results
+
+
+def configure_environment(args) -> None:
+    """Must run before server is imported: it connects at import time"""
+    os.environ["DB_NAME"] = args.db_name
+    os.environ.setdefault("BCRYPT_ROUNDS", "4")
+    if args.mongo_url:
+        os.environ["MONGO_URL"] = args.mongo_url
+        return
+    import motor.motor_asyncio
+    from mongomock_motor import AsyncMongoMockClient
+    motor.motor_asyncio.AsyncIOMotorClient = AsyncMongoMockClient
+    patch_find_one_and_update()
+    os.environ["MONGO_URL"] = "mongodb://stand-in"
+    # GridFS isn't available in the stand-in
+    os.environ["BLOB_STORE"] = "filesystem"
+    os.environ["BLOB_STORE_PATH"] = tempfile.mkdtemp(prefix="friendsnap-bench-")
+
+
+def patch_find_one_and_update() -> None:
+    """mongomock matches the filter again after updating, so with ReturnDocument.AFTER
+    any update that changes a filtered field (pending -> approved, queued -> running)
+    returns None. Return the updated document by _id, as Mongo does."""
+    from mongomock_motor import AsyncMongoMockCollection
+    from pymongo import ReturnDocument
+
+    find_one_and_update = AsyncMongoMockCollection.find_one_and_update
+
+    async def patched(self, filter, update, projection=None, sort=None, return_document=ReturnDocument.BEFORE, **kwargs):
+        if return_document != ReturnDocument.AFTER:
+            return await find_one_and_update(self, filter, update, projection=projection, sort=sort, **kwargs)
+        before = await find_one_and_update(self, filter, update, projection={"_id": 1}, sort=sort, **kwargs)
+        return None if before is None else await self.find_one({"_id": before["_id"]}, projection)
+
+    AsyncMongoMockCollection.find_one_and_update = patched
+
+
+def install_llm_stub(server, latency: float, jitter: float, rng: random.Random) -> None:
+    async def request_image_analysis(image_base64: str) -> dict:
+        await asyncio.sleep(max(0.0, latency + rng.uniform(-jitter, jitter)))
+        return stub_analysis(image_base64)
+    server.request_image_analysis = request_image_analysis
+
+
+async def seed(server, args, rng: random.Random) -> list:
+    """Create users, friendships, approved photos and messages. Returns
+    ``[{"id", "token", "friends": [...]}]`` for the virtual users."""
+    db = server.db
+    password_hash = await server.hash_password("benchmark")
+    start = datetime.now(timezone.utc) - timedelta(days=30)
+    users = []
+    for i in range(args.users):
+        user_id = str(uuid.uuid4())
+        nickname = f"bench{i}"
+        await db.users.insert_one({
+            "id": user_id,
+            "nickname": nickname,
+            "avatar_url": "",
+            "password_hash": password_hash,
+            "created_at": (start + timedelta(minutes=i)).isoformat(),
+            "is_active": True,
+        })
+        users.append({"id": user_id, "token": server.create_token(user_id, nickname), "friends": []})
+
+    pairs = set()
+    for user in users:
+        for other in rng.sample(users, min(args.friends, len(users) - 1)):
+            if other is not user:
+                pairs.add(tuple(sorted((user["id"], other["id"]))))
+    by_id = {user["id"]: user for user in users}
+    for a, b in pairs:
+        await db.friend_requests.insert_one({
+            "id": str(uuid.uuid4()), "sender_id": a, "receiver_id": b,
+            "status": "accepted", "created_at": start.isoformat()
+        })
+        await server.friendships.add(db, a, b)
+        by_id[a]["friends"].append(b)
+        by_id[b]["friends"].append(a)
+
+    for i, user in enumerate(users):
+        for j in range(args.photos):
+            data = random_png(rng)
+            image_fields = await server.store_image(data)
+            photo_id = str(uuid.uuid4())
+            await db.photos.insert_one({
+                "id": photo_id, "user_id": user["id"], **image_fields,
+                "category": "other", "tags": [], "description": "",
+                "created_at": (start + timedelta(hours=i, minutes=j)).isoformat(),
+                "is_approved": False, "status": "pending",
+            })
+            # Real moderation path, so interest index and timelines are filled too
+            await server.apply_moderation(photo_id, stub_analysis(base64.b64encode(data).decode("ascii")))
+
+    for a, b in pairs:
+        for k in range(args.messages):
+            sender, receiver = (a, b) if k % 2 == 0 else (b, a)
+            message = {
+                "id": str(uuid.uuid4()), "conversation_id": server.conversation_id(sender, receiver),
+                "sender_id": sender, "receiver_id": receiver,
+                "content": f"hello {k}", "message_type": "text",
+                "created_at": (start + timedelta(days=1, seconds=k)).isoformat(), "is_read": True,
+            }
+            await server.message_store.insert(message)
+            await server.conversation_summaries.record_message(db, message)
+    return users
+
+
+async def check_seed(server, args) -> list:
+    """Problems with the seeded state that would make the numbers meaningless"""
+    import httpx
+
+    db = server.db
+    problems = []
+    photos = args.users * args.photos
+    approved = await db.photos.count_documents({"status": "approved"})
+    if approved != photos:
+        problems.append(f"{approved}/{photos} seeded photos approved")
+    if photos:
+        if not await db[server.interest_index.COLLECTION].count_documents({}):
+            problems.append("interest index is empty")
+        if not await db[server.timelines.COLLECTION].count_documents({}):
+            problems.append("no timelines were written")
+
+    # One upload through the queue, so its workers can claim and finish jobs
+    user = await db.users.find_one({}, {"_id": 0, "id": 1, "nickname": 1})
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        response = await client.post(
+            "/api/photos", json={"image_base64": base64.b64encode(random_png(random.Random(0))).decode("ascii")},
+            headers={"Authorization": f"Bearer {server.create_token(user['id'], user['nickname'])}"}
+        )
+    if response.status_code != 200:
+        return problems + [f"upload failed with {response.status_code}"]
+    photo_id = response.json()["id"]
+    deadline = time.perf_counter() + args.llm_latency + args.llm_jitter + 10
+    while time.perf_counter() < deadline:
+        photo = await db.photos.find_one({"id": photo_id}, {"_id": 0, "status": 1})
+        if photo["status"] != "pending":
+            break
+        await asyncio.sleep(0.1)
+    else:
+        problems.append("queued upload was never moderated")
+    await db.photos.delete_one({"id": photo_id})
+    return problems
+
+
+async def run_scenario(name: str, client, user: dict, rng: random.Random, recorder: Recorder, images: list) -> None:
+    headers = {"Authorization": f"Bearer {user['token']}"}
+    partner = rng.choice(user["friends"]) if user["friends"] else None
+    if name == "feed":
+        label, request = "GET /api/photos/feed", client.get("/api/photos/feed", headers=headers)
+    elif name == "chat_poll" and partner:
+        label, request = "GET /api/messages/{user_id}", client.get(f"/api/messages/{partner}", headers=headers)
+    elif name == "send_message" and partner:
+        label, request = "POST /api/messages", client.post(
+            "/api/messages", headers=headers, json={"receiver_id": partner, "content": "hi!"}
+        )
+    elif name == "conversations":
+        label, request = "GET /api/conversations", client.get("/api/conversations", headers=headers)
+    elif name == "suggestions":
+        label, request = "GET /api/friends/suggestions", client.get("/api/friends/suggestions", headers=headers)
+    elif name == "upload":
+        label, request = "POST /api/photos", client.post(
+            "/api/photos", headers=headers, json={"image_base64": rng.choice(images)}
+        )
+    else:
+        label, request = "GET /api/friends/list", client.get("/api/friends/list", headers=headers)
+
+    started = time.perf_counter()
+    try:
+        response = await request
+        ok = response.status_code < 400
+    except Exception:
+        ok = False
+    recorder.record(label, time.perf_counter() - started, ok)
+
+
+async def drive(server, users: list, args, rng: random.Random) -> tuple:
+    import httpx
+
+    recorder = Recorder()
+    names = list(SCENARIOS)
+    weights = [SCENARIOS[name] for name in names]
+    # A pool of fresh images for uploads, so most miss the moderation cache
+    images = [base64.b64encode(random_png(rng)).decode("ascii") for _ in range(50)]
+    deadline = time.perf_counter() + args.duration
+
+    async def virtual_user(client):
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            await run_scenario(name, client, rng.choice(users), rng, recorder, images)
+
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(virtual_user(client) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+    return recorder, elapsed
+
+
+def print_report(results: dict, elapsed: float) -> None:
+    print(f"\n{'endpoint':34} {'reqs':>7} {'err':>5} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    total = 0
+    for label, r in results.items():
+        total += r["requests"]
+        print(f"{label:34} {r['requests']:7} {r['errors']:5} {r['rps']:8} {r['p50_ms']:8} {r['p95_ms']:8} {r['p99_ms']:8}")
+    print(f"\n{total} requests in {elapsed:.1f}s ({total / elapsed:.1f} req/s)")
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for label, r in results.items():
+        before = baseline.get(label)
+        if before and before["p95_ms"] > 0 and r["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{label}: p95 {before['p95_ms']} -> {r['p95_ms']} ms")
+    return regressions
+
+
+async def main(args) -> int:
+    rng = random.Random(args.seed)
+    configure_environment(args)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import server
+
+    install_llm_stub(server, args.llm_latency, args.llm_jitter, rng)
+    await server.client.drop_database(args.db_name)
+    for handler in server.app.router.on_startup:
+        await handler()
+    try:
+        print(f"Seeding {args.users} users ...")
+        seed_started = time.perf_counter()
+        users = await seed(server, args, rng)
+        problems = await check_seed(server, args)
+        if problems:
+            for problem in problems:
+                print(f"SEED ERROR  {problem}")
+            return 2
+        print(f"Seeded in {time.perf_counter() - seed_started:.1f}s, "
+              f"running {args.concurrency} virtual users for {args.duration}s")
+        recorder, elapsed = await drive(server, users, args, rng)
+    finally:
+        for handler in server.app.router.on_shutdown:
+            await handler()
+
+    results = recorder.summary(elapsed)
+    print_report(results, elapsed)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION  {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mongo-url", help="local mongod to use instead of the in-memory stand-in")
+    parser.add_argument("--db-name", default="friendsnap_bench")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--friends", type=int, default=5, help="friends per user")
+    parser.add_argument("--photos", type=int, default=3, help="photos per user")
+    parser.add_argument("--messages", type=int, default=10, help="messages per friendship")
+    parser.add_argument("--concurrency", type=int, default=20, help="virtual users")
+    parser.add_argument("--duration", type=float, default=20, help="seconds")
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="stub model latency in seconds")
+    parser.add_argument("--llm-jitter", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="results file to compare p95 latency against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p95 slowdown vs baseline")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,234 @@
+"""Content-addressed storage for photo bytes.
+
+Blobs are keyed by the SHA-256 of their content, so identical uploads are
+stored once. Two backends are available, selected with ``BLOB_STORE``:
+
+- ``gridfs`` (default): a GridFS bucket in the app database
+- ``filesystem``: files under ``BLOB_STORE_PATH``
+
+Blobs shared by several photos are reference counted by ``SharedBlobs``,
+one document per blob in the ``blobs`` collection:
+
+    {"key": "<sha256>", "refs": 2}
+"""
+import asyncio
+import hashlib
+from abc import ABC, abstractmethod
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import AsyncIterator, Iterable, Optional
+
+from gridfs.errors import FileExists
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from pymongo import IndexModel, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+CHUNK_SIZE = 256 * 1024
+
+REFS_COLLECTION = "blobs"
+REFS_INDEXES = [
+    IndexModel("key", unique=True),
+]
+# A put waits this long for a concurrent delete of the same blob to finish
+# before assuming the deleting process died and taking the blob back
+DELETE_WAIT_SECONDS = 0.05
+DELETE_CLAIM_TIMEOUT_SECONDS = 30
+
+
+def content_key(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def sniff_content_type(data: bytes) -> Optional[str]:
+    """Detect the image type from magic bytes, None if it is not an image we serve"""
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+class BlobStore(ABC):
+    """Interface shared by the storage backends"""
+
+    @abstractmethod
+    async def put(self, data: bytes) -> str:
+        """Store bytes and return their content key. Storing existing content is a no-op."""
+
+    @abstractmethod
+    async def size(self, key: str) -> Optional[int]:
+        """Size in bytes, None if the blob does not exist"""
+
+    @abstractmethod
+    def stream(self, key: str, start: int = 0, end: Optional[int] = None) -> AsyncIterator[bytes]:
+        """Yield the bytes in [start, end] (inclusive) in chunks"""
+
+    async def read(self, key: str) -> bytes:
+        return b"".join([chunk async for chunk in self.stream(key)])
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        """Delete the blob, if it exists"""
+
+
+class GridFSBlobStore(BlobStore):
+    def __init__(self, database, bucket_name: str = "photo_blobs"):
+        self.bucket = AsyncIOMotorGridFSBucket(database, bucket_name=bucket_name)
+        self.files = database[f"{bucket_name}.files"]
+
+    async def put(self, data: bytes) -> str:
+        key = content_key(data)
+        if not await self.files.find_one({"_id": key}, {"_id": 1}):
+            try:
+                await self.bucket.upload_from_stream_with_id(key, key, data)
+            except (FileExists, DuplicateKeyError):
+                # A concurrent put of the same content got there first
+                pass
+        return key
+
+    async def size(self, key: str) -> Optional[int]:
+        doc = await self.files.find_one({"_id": key}, {"length": 1})
+        return doc["length"] if doc else None
+
+    async def stream(self, key: str, start: int = 0, end: Optional[int] = None) -> AsyncIterator[bytes]:
+        grid_out = await self.bucket.open_download_stream(key)
+        end = grid_out.length - 1 if end is None else end
+        grid_out.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await grid_out.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    async def delete(self, key: str) -> None:
+        if await self.files.find_one({"_id": key}, {"_id": 1}):
+            await self.bucket.delete(key)
+
+
+class FileSystemBlobStore(BlobStore):
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / key[2:4] / key
+
+    def _write(self, key: str, data: bytes) -> None:
+        path = self._path(key)
+        if path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temp file first so readers never see a partial blob
+        fd, tmp = tempfile.mkstemp(dir=path.parent)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    async def put(self, data: bytes) -> str:
+        key = content_key(data)
+        await asyncio.to_thread(self._write, key, data)
+        return key
+
+    async def size(self, key: str) -> Optional[int]:
+        try:
+            return self._path(key).stat().st_size
+        except FileNotFoundError:
+            return None
+
+    async def stream(self, key: str, start: int = 0, end: Optional[int] = None) -> AsyncIterator[bytes]:
+        with open(self._path(key), "rb") as f:
+            f.seek(start)
+            remaining = (os.fstat(f.fileno()).st_size - 1 if end is None else end) - start + 1
+            while remaining > 0:
+                chunk = await asyncio.to_thread(f.read, min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    async def delete(self, key: str) -> None:
+        self._path(key).unlink(missing_ok=True)
+
+
+class SharedBlobs:
+    """Reference counts on top of a BlobStore. Every put adds a reference and
+    every release drops one; the bytes are deleted with the last reference.
+
+    A release that drops the count to 0 marks the blob as being deleted before
+    deleting the bytes, and a put waits for that to finish, then stores the
+    bytes again. A blob is never deleted while a photo references it."""
+
+    def __init__(self, db, store: BlobStore):
+        self.refs = db[REFS_COLLECTION]
+        self.db = db
+        self.store = store
+
+    async def put(self, data: bytes) -> str:
+        key = content_key(data)
+        await self._add_ref(key)
+        try:
+            await self.store.put(data)
+        except Exception:
+            await self.release([key])
+            raise
+        return key
+
+    async def _add_ref(self, key: str) -> None:
+        deadline = time.monotonic() + DELETE_CLAIM_TIMEOUT_SECONDS
+        while True:
+            try:
+                await self.refs.update_one(
+                    {"key": key, "deleting": {"$ne": True}}, {"$inc": {"refs": 1}}, upsert=True
+                )
+                return
+            except DuplicateKeyError:
+                # The upsert hit the document of a blob being deleted
+                if time.monotonic() > deadline:
+                    await self.refs.update_one({"key": key, "deleting": True}, {"$unset": {"deleting": ""}})
+                else:
+                    await asyncio.sleep(DELETE_WAIT_SECONDS)
+
+    async def release(self, keys: Iterable[str]) -> None:
+        """Drop one reference per key, deleting blobs nothing references anymore"""
+        for key in keys:
+            doc = await self.refs.find_one_and_update(
+                {"key": key, "deleting": {"$ne": True}}, {"$inc": {"refs": -1}},
+                projection={"_id": 0, "refs": 1}, return_document=ReturnDocument.AFTER
+            )
+            if doc is None or doc["refs"] > 0:
+                continue
+            # Only the release that claims the blob deletes it; a put in between keeps it
+            claimed = await self.refs.update_one(
+                {"key": key, "refs": {"$lte": 0}, "deleting": {"$ne": True}}, {"$set": {"deleting": True}}
+            )
+            if claimed.modified_count:
+                await self.store.delete(key)
+                await self.refs.delete_one({"key": key, "deleting": True})
+
+    async def rebuild(self) -> int:
+        """Count references from the photos' blob_keys. Returns blobs counted."""
+        counts = await self.db.photos.aggregate([
+            {"$unwind": "$blob_keys"},
+            {"$group": {"_id": "$blob_keys", "refs": {"$sum": 1}}},
+        ]).to_list(None)
+        await self.refs.delete_many({})
+        if counts:
+            await self.refs.insert_many([{"key": c["_id"], "refs": c["refs"]} for c in counts])
+        return len(counts)
+
+
+def create_blob_store(database) -> BlobStore:
+    backend = os.environ.get("BLOB_STORE", "gridfs")
+    if backend == "filesystem":
+        return FileSystemBlobStore(Path(os.environ.get("BLOB_STORE_PATH", "/app/blobs")))
+    if backend == "gridfs":
+        return GridFSBlobStore(database)
+    raise ValueError(f"Unknown BLOB_STORE backend: {backend}")
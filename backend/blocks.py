@@ -0,0 +1,104 @@
+"""Block edges and a cached, symmetric view of them.
+
+Each block is one document:
+
+    {"blocker_id", "blocked_id", "created_at"}
+
+Blocking hides both users from each other, so read paths ask for
+``hidden_ids(user)``: everyone the user blocked plus everyone who blocked
+them. That set is cached per process together with the user's ``blocks``
+view version, which every block or unblock bumps for both users. A cached
+set is only used while the version still matches, so every process stops
+showing a blocked user as soon as the edge is written.
+"""
+import os
+from datetime import datetime, timezone
+from typing import FrozenSet, Optional
+
+from pymongo import IndexModel, UpdateOne
+
+import view_versions
+from ttl_cache import TTLCache
+
+COLLECTION = "blocks"
+
+INDEXES = [
+    IndexModel([("blocker_id", 1), ("blocked_id", 1)], unique=True),
+    IndexModel("blocked_id"),
+]
+
+
+class BlockGraph:
+    def __init__(self, db, cache: TTLCache):
+        self.collection = db[COLLECTION]
+        self.db = db
+        self.cache = cache
+
+    async def block(self, blocker_id: str, blocked_id: str) -> None:
+        await self.collection.update_one(
+            {"blocker_id": blocker_id, "blocked_id": blocked_id},
+            {"$setOnInsert": {"created_at": datetime.now(timezone.utc).isoformat()}},
+            upsert=True
+        )
+        await self._invalidate(blocker_id, blocked_id)
+
+    async def unblock(self, blocker_id: str, blocked_id: str) -> None:
+        await self.collection.delete_one({"blocker_id": blocker_id, "blocked_id": blocked_id})
+        await self._invalidate(blocker_id, blocked_id)
+
+    async def _invalidate(self, *user_ids: str) -> None:
+        # Bumped after the edge is written, so a set read under the new version includes it
+        await view_versions.bump(self.db, user_ids, view_versions.BLOCKS)
+        for user_id in user_ids:
+            self.cache.invalidate(user_id)
+
+    async def hidden_ids(self, user_id: str, version: Optional[int] = None) -> FrozenSet[str]:
+        """Users blocked by or blocking user_id. Pass the user's blocks version
+        when it was already read with the other view versions."""
+        if version is None:
+            version = await view_versions.get_view(self.db, user_id, view_versions.BLOCKS)
+        cached = self.cache.get(user_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        edges = await self.collection.find(
+            {"$or": [{"blocker_id": user_id}, {"blocked_id": user_id}]},
+            {"_id": 0, "blocker_id": 1, "blocked_id": 1}
+        ).to_list(None)
+        hidden = frozenset(
+            edge["blocked_id"] if edge["blocker_id"] == user_id else edge["blocker_id"] for edge in edges
+        )
+        self.cache.set(user_id, (version, hidden))
+        return hidden
+
+    async def is_hidden(self, user_id: str, other_id: str) -> bool:
+        return other_id in await self.hidden_ids(user_id)
+
+    async def rebuild(self) -> int:
+        """Backfill edges from the blocked_users arrays used before this store. Returns edges written."""
+        ops, user_ids = [], set()
+        async for user in self.db.users.find(
+            {"blocked_users.0": {"$exists": True}}, {"_id": 0, "id": 1, "blocked_users": 1}
+        ):
+            user_ids.add(user["id"])
+            user_ids.update(user["blocked_users"])
+            for blocked_id in user["blocked_users"]:
+                ops.append(UpdateOne(
+                    {"blocker_id": user["id"], "blocked_id": blocked_id},
+                    {"$setOnInsert": {"created_at": datetime.now(timezone.utc).isoformat()}},
+                    upsert=True
+                ))
+        if ops:
+            await self.collection.bulk_write(ops, ordered=False)
+            await view_versions.bump(self.db, user_ids, view_versions.BLOCKS)
+        self.cache.clear()
+        return len(ops)
+
+    def get_stats(self) -> dict:
+        return self.cache.get_stats()
+
+
+def create_block_graph(db) -> BlockGraph:
+    return BlockGraph(db, TTLCache(
+        maxsize=int(os.environ.get("BLOCK_CACHE_SIZE", "10000")),
+        ttl=float(os.environ.get("BLOCK_CACHE_TTL_SECONDS", "30"))
+    ))
@@ -0,0 +1,100 @@
+"""Materialized per-user conversation list.
+
+One document per (user_id, partner_id) pair, kept up to date on every send
+and read so the Chat page is a single indexed read:
+
+    {"user_id", "partner_id", "last_message": {...}, "updated_at", "unread_count"}
+"""
+from typing import AsyncIterator, Dict, Iterable, List
+
+from pymongo import IndexModel, UpdateOne
+
+COLLECTION = "conversation_summaries"
+
+INDEXES = [
+    IndexModel([("user_id", 1), ("partner_id", 1)], unique=True),
+    IndexModel([("user_id", 1), ("updated_at", -1)]),
+]
+
+
+def _last_message(message: dict) -> dict:
+    return {
+        "id": message["id"],
+        "sender_id": message["sender_id"],
+        "content": message["content"],
+        "message_type": message.get("message_type", "text"),
+        "created_at": message["created_at"],
+    }
+
+
+def _record_ops(message: dict) -> List[UpdateOne]:
+    last = _last_message(message)
+    sender, receiver = message["sender_id"], message["receiver_id"]
+    return [
+        UpdateOne(
+            {"user_id": sender, "partner_id": receiver},
+            {"$set": {"last_message": last, "updated_at": last["created_at"]},
+             "$setOnInsert": {"unread_count": 0}},
+            upsert=True
+        ),
+        UpdateOne(
+            {"user_id": receiver, "partner_id": sender},
+            {"$set": {"last_message": last, "updated_at": last["created_at"]},
+             "$inc": {"unread_count": 0 if message.get("is_read") else 1}},
+            upsert=True
+        ),
+    ]
+
+
+async def record_message(db, message: dict) -> None:
+    """Update both participants' summaries for a newly sent message"""
+    await db[COLLECTION].bulk_write(_record_ops(message), ordered=False)
+
+
+async def mark_read(db, reader_id: str, partner_id: str, count: int) -> None:
+    """Subtract messages just marked read; $inc keeps concurrent sends from being lost"""
+    if count:
+        await db[COLLECTION].update_one(
+            {"user_id": reader_id, "partner_id": partner_id},
+            {"$inc": {"unread_count": -count}}
+        )
+
+
+async def mark_read_many(db, reader_id: str, counts: Dict[str, int]) -> None:
+    """mark_read for several partners at once, ``counts`` maps partner id to messages read"""
+    ops = [
+        UpdateOne({"user_id": reader_id, "partner_id": partner_id}, {"$inc": {"unread_count": -count}})
+        for partner_id, count in counts.items() if count
+    ]
+    if ops:
+        await db[COLLECTION].bulk_write(ops, ordered=False)
+
+
+async def list_for_user(db, user_id: str, limit: int = 50, exclude: Iterable[str] = ()) -> List[dict]:
+    """Newest conversations first, without those with ``exclude``d partners (e.g. blocked)"""
+    return await db[COLLECTION].find(
+        {"user_id": user_id, "partner_id": {"$nin": list(exclude)}}, {"_id": 0}
+    ).sort("updated_at", -1).limit(limit).to_list(limit)
+
+
+async def unread_total(db, user_id: str, exclude: Iterable[str] = ()) -> int:
+    result = await db[COLLECTION].aggregate([
+        {"$match": {"user_id": user_id, "partner_id": {"$nin": list(exclude)}, "unread_count": {"$gt": 0}}},
+        {"$group": {"_id": None, "total": {"$sum": "$unread_count"}}}
+    ]).to_list(1)
+    return result[0]["total"] if result else 0
+
+
+async def rebuild(db, messages: AsyncIterator[dict]) -> int:
+    """Rebuild all summaries from every stored message, oldest first within each
+    conversation (see message_store.MessageStore.iter_all). Returns summaries written."""
+    await db[COLLECTION].delete_many({})
+    ops = []
+    async for message in messages:
+        ops.extend(_record_ops(message))
+        if len(ops) >= 1000:
+            await db[COLLECTION].bulk_write(ops, ordered=True)
+            ops = []
+    if ops:
+        await db[COLLECTION].bulk_write(ops, ordered=True)
+    return await db[COLLECTION].count_documents({})
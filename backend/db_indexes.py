@@ -0,0 +1,212 @@
+"""Index registry and query-plan verification.
+
+``INDEXES`` lists every index the API's queries rely on. ``apply_indexes``
+runs on startup and is idempotent: existing indexes with the same spec are
+left alone.
+
+``QUERY_SHAPES`` mirrors the queries the API issues, with placeholder
+values. ``verify_query_plans`` explains each one and reports any that would
+fall back to a collection scan. Run it against a database with:
+
+    python db_indexes.py verify      # exits non-zero on COLLSCAN
+    python db_indexes.py apply
+"""
+import asyncio
+import logging
+import os
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure
+
+import blob_store
+import blocks
+import conversation_summaries
+import friendships
+import interest_index
+import job_queue
+import message_store
+import moderation_cache
+import similarity
+import timelines
+import view_versions
+
+logger = logging.getLogger(__name__)
+
+NEWEST_FIRST = [("created_at", -1), ("id", -1)]
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel("id", unique=True),
+        # Also makes concurrent registrations of the same nickname fail cleanly
+        IndexModel("nickname", unique=True),
+    ],
+    "photos": [
+        IndexModel("id", unique=True),
+        # Feed and my photos: keyset pagination in (created_at, id) order
+        IndexModel([("is_approved", 1), ("created_at", -1), ("id", -1)]),
+        IndexModel([("user_id", 1), ("created_at", -1), ("id", -1)]),
+        # Startup image migration; photos without the marker are indexed as null
+        IndexModel("image_layout"),
+    ],
+    "messages": message_store.INDEXES,
+    message_store.BUCKET_COLLECTION: message_store.BUCKET_INDEXES,
+    "friend_requests": [
+        IndexModel("id", unique=True),
+        IndexModel([("sender_id", 1), ("receiver_id", 1)]),
+        IndexModel([("receiver_id", 1), ("status", 1)]),
+    ],
+    "reports": [
+        IndexModel("id", unique=True),
+        IndexModel("status"),
+    ],
+    blob_store.REFS_COLLECTION: blob_store.REFS_INDEXES,
+    interest_index.COLLECTION: interest_index.INDEXES,
+    interest_index.STATS_COLLECTION: interest_index.STATS_INDEXES,
+    conversation_summaries.COLLECTION: conversation_summaries.INDEXES,
+    friendships.COLLECTION: friendships.INDEXES,
+    blocks.COLLECTION: blocks.INDEXES,
+    timelines.COLLECTION: timelines.INDEXES,
+    view_versions.COLLECTION: view_versions.INDEXES,
+    similarity.COLLECTION: similarity.INDEXES,
+    moderation_cache.COLLECTION: moderation_cache.INDEXES,
+    "moderation_jobs": job_queue.INDEXES,
+}
+
+# (collection, description, query). A query is {"filter": ..., "sort": ...}
+# for finds or {"pipeline": ...} for aggregations.
+QUERY_SHAPES = [
+    ("users", "principal / enrichment", {"filter": {"id": "x"}}),
+    ("users", "batched enrichment", {"filter": {"id": {"$in": ["x", "y"]}}}),
+    ("users", "login / register", {"filter": {"nickname": "x"}}),
+    ("users", "suggested users", {"filter": {"id": {"$in": ["x", "y"]}, "is_active": True}}),
+    ("photos", "feed", {"filter": {"is_approved": True, "user_id": {"$nin": ["x"]}}, "sort": NEWEST_FIRST}),
+    ("photos", "feed next page", {"filter": {"is_approved": True, "user_id": {"$nin": ["x"]}, "$or": [
+        {"created_at": {"$lt": "x"}}, {"created_at": "x", "id": {"$lt": "y"}}
+    ]}, "sort": NEWEST_FIRST}),
+    ("photos", "my photos", {"filter": {"user_id": "x", "status": {"$ne": "rejected"}}, "sort": NEWEST_FIRST}),
+    ("photos", "photo by id", {"filter": {"id": "x", "$or": [{"is_approved": True}, {"status": "pending"}]}}),
+    ("photos", "timeline photos", {"filter": {"id": {"$in": ["x", "y"]}, "is_approved": True}}),
+    ("photos", "own photo", {"filter": {"id": "x", "user_id": "y"}}),
+    ("photos", "image migration", {"filter": {"image_layout": {"$exists": False}}}),
+    ("photos", "suggestion samples", {"pipeline": [
+        {"$match": {"user_id": {"$in": ["x", "y"]}, "is_approved": True}},
+        {"$sort": {"created_at": -1}},
+        {"$group": {"_id": "$user_id", "photo_id": {"$first": "$id"}}}
+    ]}),
+    ("messages", "conversation page", {"filter": {"conversation_id": "x:y"}, "sort": NEWEST_FIRST}),
+    ("messages", "conversation delta", {"filter": {"conversation_id": "x:y", "$or": [
+        {"created_at": {"$gt": "t"}}, {"read_at": {"$gt": "t"}}
+    ]}}),
+    ("messages", "mark read", {"filter": {"conversation_id": "x:y", "receiver_id": "x", "is_read": False}}),
+    ("messages", "mark all read", {"filter": {"receiver_id": "x", "is_read": False, "created_at": {"$lte": "t"}}}),
+    ("messages", "since message id", {"filter": {"conversation_id": "x:y", "id": "x"}}),
+    ("messages", "all messages by conversation", {"filter": {}, "sort": message_store.BY_CONVERSATION}),
+    ("messages", "conversation id backfill", {"filter": {"conversation_id": {"$exists": False}}}),
+    (message_store.BUCKET_COLLECTION, "conversation page", {"filter": {"conversation_id": "x:y"}, "sort": [
+        ("last_created_at", -1)
+    ]}),
+    (message_store.BUCKET_COLLECTION, "conversation delta", {"filter": {"conversation_id": "x:y", "updated_at": {"$gt": "t"}}}),
+    (message_store.BUCKET_COLLECTION, "open bucket", {"filter": {"conversation_id": "x:y", "count": {"$lt": 100}}}),
+    (message_store.BUCKET_COLLECTION, "mark all read", {"filter": {"participants": "x", "messages": {"$elemMatch": {
+        "receiver_id": "x", "is_read": False, "created_at": {"$lte": "t"}
+    }}}}),
+    ("friend_requests", "existing request", {"filter": {"$or": [
+        {"sender_id": "x", "receiver_id": "y"}, {"sender_id": "y", "receiver_id": "x"}
+    ]}}),
+    ("friend_requests", "pending requests", {"filter": {"receiver_id": "x", "status": "pending", "sender_id": {"$nin": ["y"]}}}),
+    ("friend_requests", "batch accept", {"filter": {"id": {"$in": ["x", "y"]}, "receiver_id": "z", "status": "pending"}}),
+    ("friend_requests", "accept", {"filter": {"id": "x", "receiver_id": "y", "status": "pending"}}),
+    ("reports", "pending reports", {"filter": {"status": "pending"}}),
+    ("reports", "resolve", {"filter": {"id": "x"}}),
+    (interest_index.COLLECTION, "user terms", {"filter": {"user_id": "x", "count": {"$gt": 0}}}),
+    (interest_index.STATS_COLLECTION, "term frequencies", {"filter": {"term": {"$in": ["tag:x"]}}}),
+    (interest_index.COLLECTION, "posting lists", {"filter": {
+        "term": {"$in": ["tag:x"]}, "user_id": {"$nin": ["x"]}, "count": {"$gt": 0}
+    }}),
+    (blob_store.REFS_COLLECTION, "blob references", {"filter": {"key": "x", "deleting": {"$ne": True}}}),
+    (friendships.COLLECTION, "are friends", {"filter": {"user_id": "x", "friend_id": "y"}}),
+    (friendships.COLLECTION, "friend list", {"filter": {"user_id": "x"}, "sort": [("created_at", -1)]}),
+    (blocks.COLLECTION, "blocked or blocking", {"filter": {"$or": [{"blocker_id": "x"}, {"blocked_id": "x"}]}}),
+    (timelines.COLLECTION, "home timeline", {"filter": {"user_id": "x"}}),
+    (timelines.COLLECTION, "deleted photo", {"filter": {"entries.id": "x"}}),
+    (similarity.COLLECTION, "precomputed suggestions", {"filter": {"user_id": "x"}}),
+    (view_versions.COLLECTION, "view versions", {"filter": {"user_id": {"$in": ["x", view_versions.GLOBAL]}}}),
+    (view_versions.COLLECTION, "blocks version", {"filter": {"user_id": "x"}}),
+    (conversation_summaries.COLLECTION, "conversation list", {"filter": {
+        "user_id": "x", "partner_id": {"$nin": ["y"]}
+    }, "sort": [("updated_at", -1)]}),
+    (conversation_summaries.COLLECTION, "unread badge", {"pipeline": [
+        {"$match": {"user_id": "x", "partner_id": {"$nin": ["y"]}, "unread_count": {"$gt": 0}}},
+        {"$group": {"_id": None, "total": {"$sum": "$unread_count"}}}
+    ]}),
+    (moderation_cache.COLLECTION, "perceptual candidates", {"filter": {"phash_bands": {"$in": ["0:0"]}}}),
+    ("moderation_jobs", "claim", {"filter": {"$or": [
+        {"status": "queued", "run_at": {"$lte": "t"}}, {"status": "running", "locked_until": {"$lt": "t"}}
+    ]}, "sort": [("run_at", 1)]}),
+]
+
+
+async def apply_indexes(db) -> None:
+    """Create every registered index. Failures are logged, not raised, so one bad
+    index (e.g. duplicates blocking a unique index) doesn't stop the app."""
+    for collection, models in INDEXES.items():
+        try:
+            await db[collection].create_indexes(models)
+        except OperationFailure as e:
+            logger.error(f"Could not create indexes on {collection}: {e}")
+
+
+def _has_collscan(plan) -> bool:
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            return True
+        return any(_has_collscan(v) for v in plan.values())
+    if isinstance(plan, list):
+        return any(_has_collscan(v) for v in plan)
+    return False
+
+
+async def verify_query_plans(db) -> List[str]:
+    """Explain every query shape, returning descriptions of those that scan a collection"""
+    failures = []
+    for collection, description, query in QUERY_SHAPES:
+        if "pipeline" in query:
+            command = {"aggregate": collection, "pipeline": query["pipeline"], "cursor": {}}
+        else:
+            command = {"find": collection, "filter": query["filter"]}
+            if query.get("sort"):
+                command["sort"] = dict(query["sort"])
+        explain = await db.command("explain", command, verbosity="queryPlanner")
+        if _has_collscan(explain):
+            failures.append(f"{collection}: {description}")
+    return failures
+
+
+async def _main(action: str) -> int:
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ.get('DB_NAME', 'friendsnap')]
+    try:
+        if action == "apply":
+            await apply_indexes(db)
+            return 0
+        failures = await verify_query_plans(db)
+        for failure in failures:
+            print(f"COLLSCAN  {failure}")
+        print(f"{len(QUERY_SHAPES) - len(failures)}/{len(QUERY_SHAPES)} query shapes use an index")
+        return 1 if failures else 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in ("apply", "verify"):
+        print("usage: python db_indexes.py apply|verify")
+        sys.exit(2)
+    sys.exit(asyncio.run(_main(sys.argv[1])))
@@ -0,0 +1,65 @@
+"""Friendship adjacency store.
+
+Accepted friendships are stored as two directed edges, one per side:
+
+    {"user_id", "friend_id", "created_at"}
+
+so "are A and B friends" and "A's friends" are single index lookups
+instead of $or scans over friend_requests.
+"""
+from datetime import datetime, timezone
+from typing import Iterable, List, Tuple
+
+from pymongo import IndexModel, UpdateOne
+
+COLLECTION = "friendships"
+
+INDEXES = [
+    IndexModel([("user_id", 1), ("friend_id", 1)], unique=True),
+    IndexModel([("user_id", 1), ("created_at", -1)]),
+]
+
+
+def _edge_ops(user_id: str, friend_id: str, created_at: str) -> List[UpdateOne]:
+    return [
+        UpdateOne(
+            {"user_id": a, "friend_id": b},
+            {"$setOnInsert": {"created_at": created_at}},
+            upsert=True
+        )
+        for a, b in ((user_id, friend_id), (friend_id, user_id))
+    ]
+
+
+async def add(db, user_id: str, friend_id: str) -> None:
+    await add_many(db, [(user_id, friend_id)])
+
+
+async def add_many(db, pairs: Iterable[Tuple[str, str]]) -> None:
+    created_at = datetime.now(timezone.utc).isoformat()
+    ops = [op for user_id, friend_id in pairs for op in _edge_ops(user_id, friend_id, created_at)]
+    if ops:
+        await db[COLLECTION].bulk_write(ops, ordered=False)
+
+
+async def are_friends(db, user_id: str, other_id: str) -> bool:
+    return await db[COLLECTION].find_one({"user_id": user_id, "friend_id": other_id}, {"_id": 1}) is not None
+
+
+async def friend_ids(db, user_id: str, limit: int = 0) -> List[str]:
+    """Friend ids, most recent friendship first (limit 0 means all)"""
+    edges = await db[COLLECTION].find(
+        {"user_id": user_id}, {"_id": 0, "friend_id": 1}
+    ).sort("created_at", -1).limit(limit).to_list(None)
+    return [edge["friend_id"] for edge in edges]
+
+
+async def rebuild(db) -> int:
+    """Rebuild all edges from accepted friend requests. Returns edges written."""
+    await db[COLLECTION].delete_many({})
+    ops = []
+    async for req in db.friend_requests.find({"status": "accepted"}, {"_id": 0}):
+        ops.extend(_edge_ops(req["sender_id"], req["receiver_id"], req["created_at"]))
+    if ops:
+        await db[COLLECTION].bulk_write(ops, ordered=False)
+    return len(ops)
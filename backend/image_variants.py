@@ -0,0 +1,77 @@
+"""Image processing for uploaded photos.
+
+``normalize_image`` turns an upload into the image that is moderated and
+stored: orientation applied, bounded in size, re-encoded as JPEG and free of
+EXIF and other metadata (phone photos carry GPS location).
+
+``make_variants`` makes fixed-size derivatives for list views, bounded to a
+square box (aspect ratio kept, never upscaled) and re-encoded as WebP.
+
+Both are CPU bound, so callers should run them off the event loop.
+"""
+import io
+from typing import Dict
+
+from PIL import Image, ImageOps
+
+# Variant name -> longest edge in pixels, smallest first
+VARIANT_SIZES = {
+    "thumb": 160,
+    "medium": 480,
+}
+ORIGINAL = "original"
+VARIANT_FORMAT = "WEBP"
+VARIANT_CONTENT_TYPE = "image/webp"
+VARIANT_QUALITY = 80
+NORMALIZED_CONTENT_TYPE = "image/jpeg"
+NORMALIZED_QUALITY = 85
+# Refuse decompression bombs before decoding
+MAX_SOURCE_PIXELS = 50_000_000
+
+
+def normalize_image(data: bytes, max_edge: int) -> bytes:
+    """Re-encode an upload as a metadata-free JPEG no larger than max_edge on its longest side.
+    Raises ValueError when the bytes are not a readable image."""
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if image.width * image.height > MAX_SOURCE_PIXELS:
+                raise ValueError(f"Image too large: {image.width}x{image.height}")
+            # JPEGs can be decoded straight at a reduced scale
+            image.draft("RGB", (max_edge, max_edge))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+                # JPEG has no alpha: flatten onto white
+                rgba = image.convert("RGBA")
+                image = Image.new("RGB", rgba.size, (255, 255, 255))
+                image.paste(rgba, mask=rgba.getchannel("A"))
+            elif image.mode != "RGB":
+                image = image.convert("RGB")
+            out = io.BytesIO()
+            # A fresh save without exif=/icc_profile= drops all metadata
+            image.save(out, "JPEG", quality=NORMALIZED_QUALITY, optimize=True, progressive=True)
+            return out.getvalue()
+    except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+        raise ValueError(f"Not a readable image: {e}")
+
+
+def make_variants(data: bytes) -> Dict[str, dict]:
+    """Return ``{name: {"data", "content_type", "width", "height"}}`` for every size in VARIANT_SIZES"""
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info or image.mode in ("LA", "PA") else "RGB")
+
+        variants = {}
+        for name, edge in VARIANT_SIZES.items():
+            resized = image.copy()
+            resized.thumbnail((edge, edge), Image.LANCZOS)
+            out = io.BytesIO()
+            resized.save(out, VARIANT_FORMAT, quality=VARIANT_QUALITY, method=4)
+            variants[name] = {
+                "data": out.getvalue(),
+                "content_type": VARIANT_CONTENT_TYPE,
+                "width": resized.width,
+                "height": resized.height,
+            }
+        return variants
@@ -0,0 +1,168 @@
+"""Incrementally maintained interest index for friend suggestions.
+
+Each document in the ``interest_index`` collection is one posting:
+
+    {"term": "tag:dog", "user_id": "...", "count": 3}
+
+Querying by ``user_id`` gives a user's tag/category counts, querying by
+``term`` walks the posting list of users who posted that tag/category.
+
+``interest_term_stats`` keeps each term's document frequency, the number of
+postings on its list, so a query can order terms without counting them:
+
+    {"term": "tag:dog", "users": 42}
+"""
+import asyncio
+from collections import defaultdict
+from typing import Dict, Iterable, List, Set
+
+from pymongo import IndexModel, UpdateOne
+
+COLLECTION = "interest_index"
+STATS_COLLECTION = "interest_term_stats"
+TAG_PREFIX = "tag:"
+CATEGORY_PREFIX = "category:"
+
+# Upper bound on postings read per suggestion request, so a ubiquitous tag
+# cannot turn one request into a scan of the whole user base. The rarest
+# terms are read first: they say the most about shared interests, and a
+# common category can't crowd them out.
+MAX_POSTINGS_SCANNED = 5000
+
+
+def photo_terms(photo: dict) -> List[str]:
+    """Index terms contributed by one photo (deduplicated, tags then category)"""
+    terms = [TAG_PREFIX + tag for tag in dict.fromkeys(photo.get("tags", []))]
+    terms.append(CATEGORY_PREFIX + photo.get("category", ""))
+    return terms
+
+
+INDEXES = [
+    IndexModel([("user_id", 1), ("term", 1)], unique=True),
+    IndexModel([("term", 1), ("user_id", 1)]),
+]
+
+STATS_INDEXES = [
+    IndexModel("term", unique=True),
+]
+
+
+async def _count_users(db, terms: List[str], delta: int) -> None:
+    if terms:
+        await db[STATS_COLLECTION].bulk_write([
+            UpdateOne({"term": term}, {"$inc": {"users": delta}}, upsert=True) for term in terms
+        ], ordered=False)
+
+
+async def add_photo(db, photo: dict) -> None:
+    """Count a newly stored photo's tags and category for its owner"""
+    terms = photo_terms(photo)
+    ops = [
+        UpdateOne({"user_id": photo["user_id"], "term": term}, {"$inc": {"count": 1}}, upsert=True)
+        for term in terms
+    ]
+    result = await db[COLLECTION].bulk_write(ops, ordered=False)
+    # Only a newly created posting lengthens the term's list
+    await _count_users(db, [terms[i] for i in result.upserted_ids], 1)
+
+
+async def remove_photo(db, photo: dict) -> None:
+    """Undo add_photo and drop postings whose count reached zero"""
+    terms = photo_terms(photo)
+    ops = [
+        UpdateOne({"user_id": photo["user_id"], "term": term}, {"$inc": {"count": -1}})
+        for term in terms
+    ]
+    await db[COLLECTION].bulk_write(ops, ordered=False)
+    # One delete per term, so a posting is only uncounted by whoever removed it
+    deleted = await asyncio.gather(*(
+        db[COLLECTION].delete_one({"user_id": photo["user_id"], "term": term, "count": {"$lte": 0}})
+        for term in terms
+    ))
+    await _count_users(db, [term for term, result in zip(terms, deleted) if result.deleted_count], -1)
+
+
+async def get_user_terms(db, user_id: str) -> List[str]:
+    postings = await db[COLLECTION].find(
+        {"user_id": user_id, "count": {"$gt": 0}}, {"_id": 0, "term": 1}
+    ).to_list(None)
+    return [p["term"] for p in postings]
+
+
+async def find_matches(db, user_id: str, exclude: Iterable[str] = ()) -> Dict[str, Dict[str, Set[str]]]:
+    """Walk the posting lists of a user's terms.
+
+    Returns ``{other_user_id: {"tags": shared_tags, "categories": shared_categories}}``.
+    """
+    my_terms = await get_user_terms(db, user_id)
+    if not my_terms:
+        return {}
+
+    # Posting list sizes from the document frequencies, in one query
+    stats = await db[STATS_COLLECTION].find(
+        {"term": {"$in": my_terms}}, {"_id": 0, "term": 1, "users": 1}
+    ).to_list(None)
+    size_of = {term: 0 for term in my_terms}
+    size_of.update((s["term"], max(s["users"], 0)) for s in stats)
+    rarest_first = sorted(my_terms, key=lambda term: (size_of[term], term))
+
+    # Every term whose posting list fits the budget in one query, then as much
+    # of the next rarest term as is left
+    fitting, total = [], 0
+    for term in rarest_first:
+        if total + size_of[term] > MAX_POSTINGS_SCANNED:
+            break
+        fitting.append(term)
+        total += size_of[term]
+
+    excluded = [user_id, *exclude]
+    projection = {"_id": 0, "term": 1, "user_id": 1}
+    postings = []
+    if fitting:
+        # The limit only matters if the frequencies drifted below the real lists
+        postings = await db[COLLECTION].find(
+            {"term": {"$in": fitting}, "user_id": {"$nin": excluded}, "count": {"$gt": 0}}, projection
+        ).limit(MAX_POSTINGS_SCANNED).to_list(MAX_POSTINGS_SCANNED)
+    budget = MAX_POSTINGS_SCANNED - len(postings)
+    if len(fitting) < len(rarest_first) and budget > 0:
+        postings += await db[COLLECTION].find(
+            {"term": rarest_first[len(fitting)], "user_id": {"$nin": excluded}, "count": {"$gt": 0}}, projection
+        ).limit(budget).to_list(budget)
+
+    matches = defaultdict(lambda: {"tags": set(), "categories": set()})
+    for posting in postings:
+        term = posting["term"]
+        if term.startswith(TAG_PREFIX):
+            matches[posting["user_id"]]["tags"].add(term[len(TAG_PREFIX):])
+        else:
+            matches[posting["user_id"]]["categories"].add(term[len(CATEGORY_PREFIX):])
+    return dict(matches)
+
+
+async def rebuild(db) -> int:
+    """Rebuild the whole index from approved photos. Returns postings written."""
+    counts = defaultdict(int)
+    async for photo in db.photos.find({"is_approved": True}, {"_id": 0, "user_id": 1, "tags": 1, "category": 1}):
+        for term in photo_terms(photo):
+            counts[(photo["user_id"], term)] += 1
+
+    await db[COLLECTION].delete_many({})
+    if counts:
+        await db[COLLECTION].insert_many(
+            [{"user_id": uid, "term": term, "count": n} for (uid, term), n in counts.items()]
+        )
+    await rebuild_term_stats(db)
+    return len(counts)
+
+
+async def rebuild_term_stats(db) -> int:
+    """Recount every term's postings. Returns terms written."""
+    stats = await db[COLLECTION].aggregate([
+        {"$match": {"count": {"$gt": 0}}},
+        {"$group": {"_id": "$term", "users": {"$sum": 1}}},
+    ]).to_list(None)
+
+    await db[STATS_COLLECTION].delete_many({})
+    if stats:
+        await db[STATS_COLLECTION].insert_many([{"term": s["_id"], "users": s["users"]} for s in stats])
+    return len(stats)
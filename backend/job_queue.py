@@ -0,0 +1,157 @@
+"""Durable Mongo-backed job queue with a bounded asyncio worker pool.
+
+Jobs live in their own collection, so queued work survives restarts:
+
+    {"id", "payload", "status": queued|running|done|failed, "attempts",
+     "run_at", "locked_until", "last_error", "created_at", "finished_at"}
+
+Timestamps are ISO strings like the rest of the app, except ``finished_at``
+which is a BSON date for the TTL index.
+
+A worker claims a job atomically with find_one_and_update and holds a lease
+on it. A job whose worker died is picked up again once the lease expires.
+Failed attempts are retried with exponential backoff, and after
+``max_attempts`` the ``on_failure`` callback decides what happens.
+"""
+import asyncio
+import logging
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, List, Optional
+
+from pymongo import IndexModel, ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+# Indexes for any collection used as a job queue
+INDEXES = [
+    IndexModel("id", unique=True),
+    IndexModel([("status", 1), ("run_at", 1)]),
+    # Finished jobs are kept for a week for inspection
+    IndexModel("finished_at", expireAfterSeconds=7 * 86400),
+]
+
+Handler = Callable[[dict], Awaitable[None]]
+FailureHandler = Callable[[dict, Exception], Awaitable[None]]
+
+
+class JobQueue:
+    def __init__(
+        self,
+        db,
+        collection: str,
+        handler: Handler,
+        on_failure: Optional[FailureHandler] = None,
+        workers: int = 4,
+        max_attempts: int = 5,
+        backoff_base: float = 2.0,
+        lease: float = 120.0,
+        poll_interval: float = 5.0,
+    ):
+        self.collection = db[collection]
+        self.handler = handler
+        self.on_failure = on_failure
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.lease = timedelta(seconds=lease)
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    async def enqueue(self, payload: dict) -> str:
+        return (await self.enqueue_many([payload]))[0]
+
+    async def enqueue_many(self, payloads: List[dict]) -> List[str]:
+        """Queue several jobs with one insert"""
+        if not payloads:
+            return []
+        now = datetime.now(timezone.utc).isoformat()
+        jobs = [{
+            "id": str(uuid.uuid4()),
+            "payload": payload,
+            "status": "queued",
+            "attempts": 0,
+            "run_at": now,
+            "created_at": now,
+        } for payload in payloads]
+        await self.collection.insert_many(jobs)
+        self._wakeup.set()
+        return [job["id"] for job in jobs]
+
+    async def counts(self) -> dict:
+        result = await self.collection.aggregate([
+            {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+        ]).to_list(None)
+        return {r["_id"]: r["count"] for r in result}
+
+    def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._work(n)) for n in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _claim(self) -> Optional[dict]:
+        now = datetime.now(timezone.utc)
+        return await self.collection.find_one_and_update(
+            {"$or": [
+                {"status": "queued", "run_at": {"$lte": now.isoformat()}},
+                {"status": "running", "locked_until": {"$lt": now.isoformat()}},
+            ]},
+            {"$set": {"status": "running", "locked_until": (now + self.lease).isoformat()}, "$inc": {"attempts": 1}},
+            sort=[("run_at", 1)],
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def _work(self, n: int) -> None:
+        while True:
+            try:
+                job = await self._claim()
+            except Exception as e:
+                logger.error(f"Job queue worker {n} could not claim a job: {e}")
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._run(job)
+            except Exception as e:
+                logger.error(f"Job queue worker {n} crashed on job {job['id']}: {e}")
+
+    async def _run(self, job: dict) -> None:
+        try:
+            await self.handler(job["payload"])
+        except Exception as e:
+            if job["attempts"] >= self.max_attempts:
+                logger.error(f"Job {job['id']} failed after {job['attempts']} attempts: {e}")
+                await self.collection.update_one(
+                    {"id": job["id"]},
+                    {"$set": {"status": "failed", "last_error": str(e), "finished_at": datetime.now(timezone.utc)}}
+                )
+                if self.on_failure:
+                    await self.on_failure(job["payload"], e)
+                return
+            delay = self.backoff_base * 2 ** (job["attempts"] - 1) * random.uniform(0.8, 1.2)
+            logger.warning(f"Job {job['id']} attempt {job['attempts']} failed, retrying in {delay:.1f}s: {e}")
+            await self.collection.update_one(
+                {"id": job["id"]},
+                {"$set": {
+                    "status": "queued",
+                    "run_at": (datetime.now(timezone.utc) + timedelta(seconds=delay)).isoformat(),
+                    "last_error": str(e),
+                }}
+            )
+            asyncio.get_running_loop().call_later(delay, self._wakeup.set)
+            return
+        await self.collection.update_one(
+            {"id": job["id"]}, {"$set": {"status": "done", "finished_at": datetime.now(timezone.utc)}}
+        )
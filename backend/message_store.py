@@ -0,0 +1,336 @@
+"""Chat message storage keyed by conversation.
+
+Every message carries a ``conversation_id`` derived from the sorted pair of
+participants, so one chat is a contiguous range of a
+(conversation_id, created_at, id) index instead of an $or over both
+(sender_id, receiver_id) directions. Two layouts are available, selected
+with ``MESSAGE_STORAGE``:
+
+- ``documents`` (default): one document per message in ``messages``
+- ``buckets``: up to ``MESSAGE_BUCKET_SIZE`` messages per document in
+  ``message_buckets``, so the latest page of a chat is one or two reads
+
+    {"id", "conversation_id", "participants": [a, b], "count", "messages": [...],
+     "first_created_at", "last_created_at", "updated_at"}
+
+Messages are only ever appended to a bucket, so their positions in it are
+stable and read receipts update them by index.
+
+``migrate`` backfills conversation_id on existing messages and, for the
+bucket layout, copies them into buckets once.
+"""
+import logging
+import os
+import uuid
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from pymongo import IndexModel, UpdateOne
+
+logger = logging.getLogger(__name__)
+
+BUCKET_COLLECTION = "message_buckets"
+NEWEST_FIRST = [("created_at", -1), ("id", -1)]
+# One chat after another, each oldest first. The exact reverse of the
+# (conversation_id, created_at, id) index, so Mongo walks it instead of sorting.
+BY_CONVERSATION = [("conversation_id", -1), ("created_at", 1), ("id", 1)]
+BATCH_SIZE = 1000
+
+INDEXES = [
+    IndexModel("id", unique=True),
+    # Chat pages and message lookups within a chat
+    IndexModel([("conversation_id", 1), ("created_at", -1), ("id", -1)]),
+    # Delta sync of read receipts
+    IndexModel([("conversation_id", 1), ("read_at", 1)], sparse=True),
+    # Marking every conversation read
+    IndexModel([("receiver_id", 1), ("is_read", 1), ("created_at", 1)]),
+]
+
+BUCKET_INDEXES = [
+    IndexModel("id", unique=True),
+    IndexModel([("conversation_id", 1), ("last_created_at", -1)]),
+    # Delta sync: buckets with messages sent or read since the client's last sync
+    IndexModel([("conversation_id", 1), ("updated_at", 1)]),
+    # Marking every conversation of a user read
+    IndexModel("participants"),
+]
+
+
+def conversation_id(user_id: str, other_id: str) -> str:
+    """The same id for both directions of a chat"""
+    return ":".join(sorted((user_id, other_id)))
+
+
+def _sort_key(message: dict) -> tuple:
+    return message["created_at"], message["id"]
+
+
+def _changed_since(message: dict, since: str) -> bool:
+    return message["created_at"] > since or message.get("read_at", "") > since
+
+
+class MessageStore(ABC):
+    """Interface shared by the storage layouts"""
+
+    @abstractmethod
+    async def insert(self, message: dict) -> None:
+        """Store a new message, which must have its conversation_id set"""
+
+    @abstractmethod
+    async def page(self, conversation: str, limit: int, before: Optional[Tuple[str, str]] = None) -> List[dict]:
+        """Up to ``limit`` messages older than ``before`` (created_at, id), newest first"""
+
+    @abstractmethod
+    async def find(self, conversation: str, message_id: str) -> Optional[dict]:
+        """The message with this id in the conversation, None if there is none"""
+
+    @abstractmethod
+    async def changes(self, conversation: str, since: str) -> List[dict]:
+        """Messages created or read after ``since``, oldest first"""
+
+    @abstractmethod
+    async def mark_read(self, reader_id: str, partner_id: str, read_at: str) -> int:
+        """Mark the partner's unread messages to the reader as read. Returns how many were marked."""
+
+    @abstractmethod
+    async def mark_all_read(self, reader_id: str, partner_ids: Optional[List[str]], read_at: str) -> Dict[str, int]:
+        """Mark messages to the reader sent up to ``read_at`` as read, from the given partners
+        or from everyone when None. Returns the number marked per partner."""
+
+    @abstractmethod
+    def iter_all(self) -> AsyncIterator[dict]:
+        """Every message, oldest first within each conversation"""
+
+    @abstractmethod
+    async def migrate(self) -> int:
+        """Bring existing messages into this layout. Returns messages migrated."""
+
+
+async def backfill_conversation_ids(db) -> int:
+    """Set conversation_id on messages stored before it existed"""
+    written = 0
+    ops = []
+    async for message in db.messages.find(
+        {"conversation_id": {"$exists": False}}, {"_id": 1, "sender_id": 1, "receiver_id": 1}
+    ):
+        ops.append(UpdateOne(
+            {"_id": message["_id"]},
+            {"$set": {"conversation_id": conversation_id(message["sender_id"], message["receiver_id"])}}
+        ))
+        if len(ops) >= BATCH_SIZE:
+            written += (await db.messages.bulk_write(ops, ordered=False)).modified_count
+            ops = []
+    if ops:
+        written += (await db.messages.bulk_write(ops, ordered=False)).modified_count
+    return written
+
+
+class DocumentMessageStore(MessageStore):
+    def __init__(self, db):
+        self.collection = db.messages
+        self.db = db
+
+    async def insert(self, message: dict) -> None:
+        await self.collection.insert_one(dict(message))
+
+    async def page(self, conversation: str, limit: int, before: Optional[Tuple[str, str]] = None) -> List[dict]:
+        query = {"conversation_id": conversation}
+        if before:
+            query["$or"] = [
+                {"created_at": {"$lt": before[0]}},
+                {"created_at": before[0], "id": {"$lt": before[1]}}
+            ]
+        return await self.collection.find(query, {"_id": 0}).sort(NEWEST_FIRST).limit(limit).to_list(limit)
+
+    async def find(self, conversation: str, message_id: str) -> Optional[dict]:
+        return await self.collection.find_one({"conversation_id": conversation, "id": message_id}, {"_id": 0})
+
+    async def changes(self, conversation: str, since: str) -> List[dict]:
+        return await self.collection.find(
+            {"conversation_id": conversation, "$or": [
+                {"created_at": {"$gt": since}}, {"read_at": {"$gt": since}}
+            ]},
+            {"_id": 0}
+        ).sort([("created_at", 1), ("id", 1)]).to_list(None)
+
+    async def mark_read(self, reader_id: str, partner_id: str, read_at: str) -> int:
+        result = await self.collection.update_many(
+            {"conversation_id": conversation_id(reader_id, partner_id), "receiver_id": reader_id, "is_read": False},
+            {"$set": {"is_read": True, "read_at": read_at}}
+        )
+        return result.modified_count
+
+    async def mark_all_read(self, reader_id: str, partner_ids: Optional[List[str]], read_at: str) -> Dict[str, int]:
+        # Messages arriving meanwhile stay unread, so the per-partner counts match what is updated
+        unread = {"receiver_id": reader_id, "is_read": False, "created_at": {"$lte": read_at}}
+        if partner_ids is not None:
+            unread["sender_id"] = {"$in": partner_ids}
+        counts = await self.collection.aggregate([
+            {"$match": unread},
+            {"$group": {"_id": "$sender_id", "count": {"$sum": 1}}}
+        ]).to_list(None)
+        if counts:
+            await self.collection.update_many(unread, {"$set": {"is_read": True, "read_at": read_at}})
+        return {c["_id"]: c["count"] for c in counts}
+
+    async def iter_all(self) -> AsyncIterator[dict]:
+        async for message in self.collection.find({}, {"_id": 0}).sort(BY_CONVERSATION):
+            yield message
+
+    async def migrate(self) -> int:
+        return await backfill_conversation_ids(self.db)
+
+
+class BucketMessageStore(MessageStore):
+    def __init__(self, db, bucket_size: int = 100):
+        self.db = db
+        self.collection = db[BUCKET_COLLECTION]
+        self.bucket_size = bucket_size
+
+    async def insert(self, message: dict) -> None:
+        created_at = message["created_at"]
+        # Two concurrent sends may each open a bucket; both fill up later, pages merge them
+        await self.collection.update_one(
+            {"conversation_id": message["conversation_id"], "count": {"$lt": self.bucket_size}},
+            {
+                "$push": {"messages": message},
+                "$inc": {"count": 1},
+                "$min": {"first_created_at": created_at},
+                "$max": {"last_created_at": created_at, "updated_at": created_at},
+                "$setOnInsert": {
+                    "id": str(uuid.uuid4()),
+                    "participants": sorted((message["sender_id"], message["receiver_id"])),
+                },
+            },
+            upsert=True
+        )
+
+    async def page(self, conversation: str, limit: int, before: Optional[Tuple[str, str]] = None) -> List[dict]:
+        query = {"conversation_id": conversation}
+        if before:
+            query["first_created_at"] = {"$lte": before[0]}
+        page = []
+        async for bucket in self.collection.find(query, {"_id": 0, "messages": 1, "last_created_at": 1}).sort(
+            "last_created_at", -1
+        ):
+            # Buckets may overlap in time; stop once no later bucket can hold a newer message
+            if len(page) >= limit and bucket["last_created_at"] < page[limit - 1]["created_at"]:
+                break
+            page.extend(m for m in bucket["messages"] if not before or _sort_key(m) < before)
+            page.sort(key=_sort_key, reverse=True)
+        return page[:limit]
+
+    async def find(self, conversation: str, message_id: str) -> Optional[dict]:
+        bucket = await self.collection.find_one(
+            {"conversation_id": conversation, "messages.id": message_id},
+            {"_id": 0, "messages": {"$elemMatch": {"id": message_id}}}
+        )
+        return bucket["messages"][0] if bucket else None
+
+    async def changes(self, conversation: str, since: str) -> List[dict]:
+        buckets = await self.collection.find(
+            {"conversation_id": conversation, "updated_at": {"$gt": since}}, {"_id": 0, "messages": 1}
+        ).to_list(None)
+        messages = [m for bucket in buckets for m in bucket["messages"] if _changed_since(m, since)]
+        return sorted(messages, key=_sort_key)
+
+    async def _mark_buckets(self, query: dict, is_unread: Callable[[dict], bool], read_at: str) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        async for bucket in self.collection.find(query, {"messages": 1}):
+            while True:
+                positions = [i for i, m in enumerate(bucket["messages"]) if is_unread(m)]
+                if not positions:
+                    break
+                update = {"$set": {}, "$max": {"updated_at": read_at}}
+                guard = {"_id": bucket["_id"]}
+                for i in positions:
+                    update["$set"][f"messages.{i}.is_read"] = True
+                    update["$set"][f"messages.{i}.read_at"] = read_at
+                    guard[f"messages.{i}.is_read"] = False
+                result = await self.collection.update_one(guard, update)
+                if result.modified_count:
+                    for i in positions:
+                        sender = bucket["messages"][i]["sender_id"]
+                        counts[sender] = counts.get(sender, 0) + 1
+                    break
+                # Marked read concurrently: reload so no message is counted twice
+                bucket = await self.collection.find_one({"_id": bucket["_id"]}, {"messages": 1})
+        return counts
+
+    async def mark_read(self, reader_id: str, partner_id: str, read_at: str) -> int:
+        counts = await self._mark_buckets(
+            {"conversation_id": conversation_id(reader_id, partner_id),
+             "messages": {"$elemMatch": {"receiver_id": reader_id, "is_read": False}}},
+            lambda m: m["receiver_id"] == reader_id and not m["is_read"],
+            read_at
+        )
+        return counts.get(partner_id, 0)
+
+    async def mark_all_read(self, reader_id: str, partner_ids: Optional[List[str]], read_at: str) -> Dict[str, int]:
+        query = {
+            "participants": reader_id,
+            "messages": {"$elemMatch": {"receiver_id": reader_id, "is_read": False, "created_at": {"$lte": read_at}}},
+        }
+        if partner_ids is not None:
+            query["conversation_id"] = {"$in": [conversation_id(reader_id, pid) for pid in partner_ids]}
+        return await self._mark_buckets(
+            query,
+            lambda m: m["receiver_id"] == reader_id and not m["is_read"] and m["created_at"] <= read_at,
+            read_at
+        )
+
+    async def iter_all(self) -> AsyncIterator[dict]:
+        conversation, messages = None, []
+        async for bucket in self.collection.find({}, {"_id": 0, "conversation_id": 1, "messages": 1}).sort(
+            "conversation_id", 1
+        ):
+            if bucket["conversation_id"] != conversation:
+                for message in sorted(messages, key=_sort_key):
+                    yield message
+                conversation, messages = bucket["conversation_id"], []
+            messages.extend(bucket["messages"])
+        for message in sorted(messages, key=_sort_key):
+            yield message
+
+    async def migrate(self) -> int:
+        """Copy messages into buckets, once: only while no bucket exists yet.
+        The messages collection is left as it was."""
+        await backfill_conversation_ids(self.db)
+        if await self.collection.estimated_document_count():
+            return 0
+        migrated = 0
+        buckets = []
+        current = None
+        async for message in self.db.messages.find({}, {"_id": 0}).sort(BY_CONVERSATION):
+            if current is None or current["conversation_id"] != message["conversation_id"] \
+                    or current["count"] >= self.bucket_size:
+                current = {
+                    "id": str(uuid.uuid4()),
+                    "conversation_id": message["conversation_id"],
+                    "participants": sorted((message["sender_id"], message["receiver_id"])),
+                    "count": 0,
+                    "messages": [],
+                    "first_created_at": message["created_at"],
+                }
+                buckets.append(current)
+            current["messages"].append(message)
+            current["count"] += 1
+            current["last_created_at"] = message["created_at"]
+            current["updated_at"] = max(current.get("updated_at", ""), message["created_at"], message.get("read_at", ""))
+            migrated += 1
+            # Keep only the open bucket in memory
+            if len(buckets) > BATCH_SIZE // self.bucket_size + 1:
+                await self.collection.insert_many(buckets[:-1])
+                buckets = buckets[-1:]
+        if buckets:
+            await self.collection.insert_many(buckets)
+        return migrated
+
+
+def create_message_store(db) -> MessageStore:
+    layout = os.environ.get("MESSAGE_STORAGE", "documents")
+    if layout == "documents":
+        return DocumentMessageStore(db)
+    if layout == "buckets":
+        return BucketMessageStore(db, bucket_size=int(os.environ.get("MESSAGE_BUCKET_SIZE", "100")))
+    raise ValueError(f"Unknown MESSAGE_STORAGE layout: {layout}")
@@ -0,0 +1,188 @@
+"""Minimal Prometheus metrics: histograms and scrape-time gauges
+rendered in the text exposition format.
+
+Mongo commands are timed by a pymongo ``CommandListener``. The commands
+run on motor's executor threads, which inherit the request's context, so
+``track_request`` can count them per request through a context variable.
+"""
+import asyncio
+import bisect
+import contextvars
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from pymongo import monitoring
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds. Fine at the low end for Mongo and loop lag, long tail for the model.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+_lock = threading.Lock()
+_registry = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self._values: Dict[tuple, list] = {}
+        _registry.append(self)
+
+    def observe(self, value: float, *labels: str) -> None:
+        with _lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, series in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(series[-1])}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}"
+
+
+class Gauge:
+    """Read when scraped, from a callback returning {label_values: value}"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str], collect: Callable[[], dict]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        _registry.append(self)
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} gauge"
+        for labels, value in sorted(self.collect().items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+def stats_gauge(name: str, documentation: str, get_stats: Callable[[], dict]) -> Gauge:
+    """Expose the numeric fields of a component's get_stats() dict, one series per field"""
+    return Gauge(name, documentation, ("stat",), lambda: {
+        (key,): value for key, value in get_stats().items()
+        if isinstance(value, (int, float)) and not isinstance(value, bool)
+    })
+
+
+def render() -> str:
+    with _lock:
+        return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+
+# ==================== APP METRICS ====================
+
+http_request_duration = Histogram(
+    "friendsnap_http_request_duration_seconds", "HTTP request latency", ("method", "route", "status")
+)
+http_request_mongo_commands = Histogram(
+    "friendsnap_http_request_mongo_commands", "Mongo commands issued per HTTP request", ("method", "route"),
+    buckets=COUNT_BUCKETS
+)
+http_request_mongo_seconds = Histogram(
+    "friendsnap_http_request_mongo_seconds", "Time spent in Mongo commands per HTTP request", ("method", "route")
+)
+mongo_command_duration = Histogram(
+    "friendsnap_mongo_command_duration_seconds", "Mongo command latency", ("command", "outcome")
+)
+llm_request_duration = Histogram(
+    "friendsnap_llm_request_duration_seconds", "Image analysis model call latency", ("outcome",)
+)
+event_loop_lag = Histogram(
+    "friendsnap_event_loop_lag_seconds", "How late a periodic event-loop timer fired"
+)
+
+
+class _RequestStats:
+    __slots__ = ("commands", "seconds")
+
+    def __init__(self):
+        self.commands = 0
+        self.seconds = 0.0
+
+
+_current_request: contextvars.ContextVar[Optional[_RequestStats]] = contextvars.ContextVar(
+    "friendsnap_request_stats", default=None
+)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    def _finished(self, event, outcome: str) -> None:
+        seconds = event.duration_micros / 1e6
+        mongo_command_duration.observe(seconds, event.command_name, outcome)
+        stats = _current_request.get()
+        if stats is not None:
+            stats.commands += 1
+            stats.seconds += seconds
+
+    def started(self, event) -> None:
+        pass
+
+    def succeeded(self, event) -> None:
+        self._finished(event, "ok")
+
+    def failed(self, event) -> None:
+        self._finished(event, "error")
+
+
+def route_label(scope: dict) -> str:
+    """Route template, so /api/photos/{photo_id}/image is one series and not one per photo"""
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+async def track_request(request, call_next):
+    """HTTP middleware recording latency and Mongo usage per route and status"""
+    stats = _RequestStats()
+    token = _current_request.set(stats)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        _current_request.reset(token)
+        method, route = request.method, route_label(request.scope)
+        http_request_duration.observe(time.perf_counter() - started, method, route, str(status))
+        http_request_mongo_commands.observe(stats.commands, method, route)
+        http_request_mongo_seconds.observe(stats.seconds, method, route)
+
+
+async def monitor_event_loop(interval: float = 0.5) -> None:
+    """Runs until cancelled, observing how late each sleep wakes up"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        event_loop_lag.observe(max(0.0, loop.time() - started - interval))
@@ -0,0 +1,156 @@
+"""Cache of AI moderation results keyed by image content.
+
+Lookups try, in order:
+
+1. an in-process LRU keyed by the SHA-256 of the image bytes
+2. the ``moderation_cache`` collection by the same exact hash
+3. the collection by perceptual hash (dHash) within a Hamming distance,
+   so re-encoded or resized copies of an image also hit
+
+Entries expire through a TTL index. Only real model answers are stored,
+never the fallback used when the model call fails.
+"""
+import asyncio
+import hashlib
+import io
+import logging
+import os
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from PIL import Image
+from pymongo import IndexModel
+
+logger = logging.getLogger(__name__)
+
+COLLECTION = "moderation_cache"
+
+INDEXES = [
+    IndexModel("expires_at", expireAfterSeconds=0),
+    IndexModel("phash_bands"),
+]
+
+# The 64-bit dHash is split into bands that are indexed for exact match.
+# Two hashes within distance d agree on at least one of d + 1 bands, so
+# 4 bands support distances up to 3.
+PHASH_BANDS = 4
+PHASH_BAND_BITS = 64 // PHASH_BANDS
+MAX_SUPPORTED_DISTANCE = PHASH_BANDS - 1
+MAX_CANDIDATES = 200
+# Near-flat images (blank walls, solid colours) all hash to almost the same
+# value, so they only ever match exactly
+MIN_DISTINCT_BITS = 8
+
+
+def dhash(data: bytes) -> int:
+    """64-bit difference hash of an image: compares neighbouring pixels of a 9x8 grayscale copy"""
+    with Image.open(io.BytesIO(data)) as image:
+        pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def phash_bands(value: int) -> list:
+    mask = (1 << PHASH_BAND_BITS) - 1
+    return [f"{i}:{(value >> (i * PHASH_BAND_BITS)) & mask:x}" for i in range(PHASH_BANDS)]
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def is_distinctive(value: int) -> bool:
+    ones = bin(value).count("1")
+    return MIN_DISTINCT_BITS <= ones <= 64 - MIN_DISTINCT_BITS
+
+
+class ModerationCache:
+    def __init__(self, db, ttl: timedelta, memory_size: int, max_distance: int):
+        self.collection = db[COLLECTION]
+        self.ttl = ttl
+        self.memory_size = memory_size
+        if max_distance > MAX_SUPPORTED_DISTANCE:
+            logger.warning(f"Moderation cache distance {max_distance} capped to {MAX_SUPPORTED_DISTANCE}")
+        self.max_distance = min(max_distance, MAX_SUPPORTED_DISTANCE)
+        self._memory = OrderedDict()
+        self.stats = {"memory_hits": 0, "exact_hits": 0, "perceptual_hits": 0, "misses": 0, "stores": 0}
+
+    def _remember(self, key: str, result: dict) -> None:
+        self._memory[key] = result
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    async def _phash(self, data: bytes) -> Optional[int]:
+        """Perceptual hash, None when it can't be computed or is too featureless to match on"""
+        try:
+            value = await asyncio.to_thread(dhash, data)
+        except Exception as e:
+            logger.warning(f"Could not compute perceptual hash: {e}")
+            return None
+        return value if is_distinctive(value) else None
+
+    async def lookup(self, data: bytes) -> Optional[dict]:
+        key = hashlib.sha256(data).hexdigest()
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.stats["memory_hits"] += 1
+            return self._memory[key]
+
+        doc = await self.collection.find_one({"_id": key}, {"result": 1})
+        if doc:
+            self.stats["exact_hits"] += 1
+            self._remember(key, doc["result"])
+            return doc["result"]
+
+        if self.max_distance > 0:
+            value = await self._phash(data)
+            if value is not None:
+                candidates = await self.collection.find(
+                    {"phash_bands": {"$in": phash_bands(value)}}, {"phash": 1, "result": 1}
+                ).to_list(MAX_CANDIDATES)
+                best = min(candidates, key=lambda c: hamming(value, int(c["phash"], 16)), default=None)
+                if best and hamming(value, int(best["phash"], 16)) <= self.max_distance:
+                    self.stats["perceptual_hits"] += 1
+                    self._remember(key, best["result"])
+                    return best["result"]
+
+        self.stats["misses"] += 1
+        return None
+
+    async def store(self, data: bytes, result: dict) -> None:
+        key = hashlib.sha256(data).hexdigest()
+        self._remember(key, result)
+        doc = {"result": result, "expires_at": datetime.now(timezone.utc) + self.ttl}
+        value = await self._phash(data)
+        if value is not None:
+            doc["phash"] = f"{value:016x}"
+            doc["phash_bands"] = phash_bands(value)
+        await self.collection.update_one({"_id": key}, {"$set": doc}, upsert=True)
+        self.stats["stores"] += 1
+
+    def get_stats(self) -> dict:
+        hits = self.stats["memory_hits"] + self.stats["exact_hits"] + self.stats["perceptual_hits"]
+        total = hits + self.stats["misses"]
+        return {
+            **self.stats,
+            "hits": hits,
+            "hit_rate": round(hits / total, 4) if total else 0.0,
+            "memory_entries": len(self._memory),
+            "max_distance": self.max_distance,
+        }
+
+
+def create_moderation_cache(db) -> ModerationCache:
+    return ModerationCache(
+        db,
+        ttl=timedelta(days=float(os.environ.get("MODERATION_CACHE_TTL_DAYS", "30"))),
+        memory_size=int(os.environ.get("MODERATION_CACHE_MEMORY_SIZE", "1024")),
+        max_distance=int(os.environ.get("MODERATION_CACHE_MAX_DISTANCE", "2")),
+    )
@@ -0,0 +1,149 @@
+"""Long-lived client around the image analysis model call.
+
+- every call has a deadline, so a hung provider can't hold a worker
+- concurrent analyses of the same image share one model call
+- a circuit breaker stops calling the provider while most recent calls
+  fail, raising ``CircuitOpen`` right away instead. After a cooldown one
+  probe call is let through; if it succeeds the circuit closes again.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class ModerationClient:
+    def __init__(
+        self,
+        call: Callable[[str], Awaitable[dict]],
+        timeout: float = 30.0,
+        error_rate: float = 0.5,
+        min_calls: int = 5,
+        window: float = 60.0,
+        cooldown: float = 30.0,
+    ):
+        self.call = call
+        self.timeout = timeout
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self._outcomes = deque()  # (monotonic time, ok)
+        self._in_flight = {}
+        self._probing = False
+        self.stats = {"calls": 0, "failures": 0, "timeouts": 0, "coalesced": 0, "short_circuited": 0, "opened": 0}
+
+    async def analyze(self, image_base64: str) -> dict:
+        key = hashlib.sha256(image_base64.encode("ascii")).hexdigest()
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self._admit()
+            task = asyncio.ensure_future(self._call(image_base64))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._finished(key, t))
+        # Shielded so one caller giving up doesn't cancel the call for the others
+        return await asyncio.shield(task)
+
+    def _finished(self, key: str, task: asyncio.Future) -> None:
+        self._in_flight.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # retrieved here in case every caller gave up
+
+    def _admit(self) -> None:
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.cooldown:
+                self.stats["short_circuited"] += 1
+                raise CircuitOpen("Image analysis is unavailable, circuit open")
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            if self._probing:
+                self.stats["short_circuited"] += 1
+                raise CircuitOpen("Image analysis is unavailable, waiting for probe call")
+            self._probing = True
+
+    async def _call(self, image_base64: str) -> dict:
+        self.stats["calls"] += 1
+        try:
+            result = await asyncio.wait_for(self.call(image_base64), self.timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            self._record(False)
+            raise
+        except asyncio.CancelledError:
+            self._probing = False
+            raise
+        except Exception:
+            self._record(False)
+            raise
+        self._record(True)
+        return result
+
+    def _record(self, ok: bool) -> None:
+        now = time.monotonic()
+        if not ok:
+            self.stats["failures"] += 1
+        if self.state == HALF_OPEN:
+            self._probing = False
+            if ok:
+                logger.info("Image analysis recovered, circuit closed")
+                self.state = CLOSED
+                self._outcomes.clear()
+            else:
+                self._open(now)
+            return
+
+        self._outcomes.append((now, ok))
+        while self._outcomes and self._outcomes[0][0] < now - self.window:
+            self._outcomes.popleft()
+        failures = sum(1 for _, succeeded in self._outcomes if not succeeded)
+        if (self.state == CLOSED and len(self._outcomes) >= self.min_calls
+                and failures / len(self._outcomes) >= self.error_rate):
+            logger.error(f"Image analysis failing ({failures}/{len(self._outcomes)} recent calls), circuit opened")
+            self._open(now)
+
+    def _open(self, now: float) -> None:
+        self.state = OPEN
+        self.opened_at = now
+        self.stats["opened"] += 1
+
+    def get_stats(self) -> dict:
+        failures = sum(1 for _, ok in self._outcomes if not ok)
+        return {
+            **self.stats,
+            "state": self.state,
+            "open": int(self.state != CLOSED),
+            "in_flight": len(self._in_flight),
+            "recent_calls": len(self._outcomes),
+            "recent_error_rate": round(failures / len(self._outcomes), 4) if self._outcomes else 0.0,
+            "seconds_until_probe": (
+                max(0.0, round(self.cooldown - (time.monotonic() - self.opened_at), 1)) if self.state == OPEN else 0.0
+            ),
+        }
+
+
+def create_moderation_client(call: Callable[[str], Awaitable[dict]]) -> ModerationClient:
+    return ModerationClient(
+        call,
+        timeout=float(os.environ.get("LLM_TIMEOUT_SECONDS", "30")),
+        error_rate=float(os.environ.get("LLM_BREAKER_ERROR_RATE", "0.5")),
+        min_calls=int(os.environ.get("LLM_BREAKER_MIN_CALLS", "5")),
+        window=float(os.environ.get("LLM_BREAKER_WINDOW_SECONDS", "60")),
+        cooldown=float(os.environ.get("LLM_BREAKER_COOLDOWN_SECONDS", "30")),
+    )
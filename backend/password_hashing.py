@@ -0,0 +1,98 @@
+"""bcrypt hashing off the event loop.
+
+bcrypt is deliberately slow (100-300 ms at the usual cost) and releases the
+GIL, so hashes run on a small thread pool instead of blocking every other
+request. The number of waiting hashes is capped, so a login storm gets
+fast 503s instead of an ever-growing queue.
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+
+class HashingOverloaded(Exception):
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, rounds: int = 12, workers: int = 2, max_queue: int = 64):
+        self.rounds = rounds
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._in_flight = 0
+        self.stats = {
+            "hashes": 0,
+            "rejected": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+            "run_seconds_total": 0.0,
+            "run_seconds_max": 0.0,
+        }
+
+    def _timed(self, queued_at: float, fn, *args):
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            wait = started - queued_at
+            run = time.perf_counter() - started
+            self.stats["wait_seconds_total"] += wait
+            self.stats["wait_seconds_max"] = max(self.stats["wait_seconds_max"], wait)
+            self.stats["run_seconds_total"] += run
+            self.stats["run_seconds_max"] = max(self.stats["run_seconds_max"], run)
+
+    async def _submit(self, fn, *args):
+        if self._in_flight >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise HashingOverloaded()
+        self._in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, self._timed, time.perf_counter(), fn, *args)
+        finally:
+            self._in_flight -= 1
+            self.stats["hashes"] += 1
+
+    def _hash(self, password: str) -> str:
+        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=self.rounds)).decode('utf-8')
+
+    @staticmethod
+    def _verify(password: str, hashed: str) -> bool:
+        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+    async def hash(self, password: str) -> str:
+        return await self._submit(self._hash, password)
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._submit(self._verify, password, hashed)
+
+    def needs_rehash(self, hashed: str) -> bool:
+        """True when the stored hash uses a different cost than configured ($2b$<cost>$...)"""
+        try:
+            return int(hashed.split("$")[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def get_stats(self) -> dict:
+        hashes = self.stats["hashes"] or 1
+        return {
+            **self.stats,
+            "rounds": self.rounds,
+            "in_flight": self._in_flight,
+            "wait_seconds_avg": self.stats["wait_seconds_total"] / hashes,
+            "run_seconds_avg": self.stats["run_seconds_total"] / hashes,
+        }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
+
+
+def create_password_hasher() -> PasswordHasher:
+    return PasswordHasher(
+        rounds=int(os.environ.get("BCRYPT_ROUNDS", "12")),
+        workers=int(os.environ.get("PASSWORD_HASH_WORKERS", "2")),
+        max_queue=int(os.environ.get("PASSWORD_HASH_MAX_QUEUE", "64")),
+    )
@@ -0,0 +1,64 @@
+"""Pub/sub broker used to push chat events to connected clients.
+
+Events are published to per-user channels (see ``user_channel``). The
+``Broker`` interface is what the API talks to; ``InMemoryBroker`` delivers
+within one process. A shared backend (e.g. Redis) can be added by
+implementing the same interface and selecting it with ``REALTIME_BROKER``.
+"""
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+import os
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Set
+
+logger = logging.getLogger(__name__)
+
+# Events buffered per subscriber before the oldest is dropped, so one slow
+# socket cannot grow memory without bound
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+def user_channel(user_id: str) -> str:
+    return f"user:{user_id}"
+
+
+class Broker(ABC):
+    @abstractmethod
+    async def publish(self, channel: str, event: dict) -> None:
+        """Deliver the event to every subscriber of the channel"""
+
+    @abstractmethod
+    def subscribe(self, channel: str):
+        """Async context manager yielding an asyncio.Queue of events for the channel"""
+
+
+class InMemoryBroker(Broker):
+    def __init__(self):
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = defaultdict(set)
+
+    async def publish(self, channel: str, event: dict) -> None:
+        for queue in list(self._subscribers.get(channel, ())):
+            if queue.full():
+                queue.get_nowait()
+                logger.warning(f"Dropped oldest event for slow subscriber on {channel}")
+            queue.put_nowait(event)
+
+    @asynccontextmanager
+    async def subscribe(self, channel: str) -> AsyncIterator[asyncio.Queue]:
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self._subscribers[channel].add(queue)
+        try:
+            yield queue
+        finally:
+            self._subscribers[channel].discard(queue)
+            if not self._subscribers[channel]:
+                del self._subscribers[channel]
+
+
+def create_broker() -> Broker:
+    backend = os.environ.get("REALTIME_BROKER", "memory")
+    if backend == "memory":
+        return InMemoryBroker()
+    raise ValueError(f"Unknown REALTIME_BROKER backend: {backend}")
@@ -1,27 +1,75 @@
-from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Depends
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import Response, StreamingResponse
+from fastapi.exceptions import RequestValidationError
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.formparsers import MultiPartParser, MultiPartException
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
+from pydantic import BaseModel, Field, ConfigDict, ValidationError
 from typing import List, Optional
 import uuid
 from datetime import datetime, timezone
 import jwt
-import bcrypt
 import base64
+import binascii
+import json
+import asyncio
+import time
+import hashlib
+import hmac
+from urllib.parse import urlencode
 from emergentintegrations.llm.chat import LlmChat, UserMessage, ImageContent
 
+import interest_index
+import metrics
+import blocks
+import conversation_summaries
+import friendships
+import similarity
+import timelines
+import view_versions
+from moderation_cache import create_moderation_cache
+from moderation_client import create_moderation_client, CircuitOpen
+from message_store import create_message_store, conversation_id
+from job_queue import JobQueue
+from password_hashing import create_password_hasher, HashingOverloaded
+from ttl_cache import TTLCache
+from db_indexes import apply_indexes, NEWEST_FIRST
+from blob_store import SharedBlobs, create_blob_store, sniff_content_type
+from image_variants import make_variants, normalize_image, VARIANT_SIZES, ORIGINAL
+from realtime import create_broker, user_channel
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ.get('MONGO_URL')
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[metrics.MongoCommandListener()])
 db = client[os.environ.get('DB_NAME', 'friendsnap')]
+blob_store = create_blob_store(db)
+shared_blobs = SharedBlobs(db, blob_store)
+broker = create_broker()
+moderation_cache = create_moderation_cache(db)
+# Resolved per call, so tests and the benchmark can swap request_image_analysis
+moderation_client = create_moderation_client(lambda image_base64: request_image_analysis(image_base64))
+password_hasher = create_password_hasher()
+block_graph = blocks.create_block_graph(db)
+message_store = create_message_store(db)
+
+# Authenticated principals by user id. Profile fields are only written at
+# registration; a future write to them must call principal_cache.invalidate.
+principal_cache = TTLCache(
+    maxsize=int(os.environ.get("PRINCIPAL_CACHE_SIZE", "10000")),
+    ttl=float(os.environ.get("PRINCIPAL_CACHE_TTL_SECONDS", "60"))
+)
+# Blocks live in block_graph; the legacy blocked_users array is only read to backfill it
+PRINCIPAL_PROJECTION = {"_id": 0, "password_hash": 0, "blocked_users": 0}
 
 # JWT Secret
 JWT_SECRET = os.environ.get('JWT_SECRET', 'friendsnap-secret-key-change-in-production')
@@ -58,11 +106,16 @@ class PhotoUpload(BaseModel):
     category: str = ""
     description: str = ""
 
+MAX_BATCH_PHOTOS = 10
+
+class PhotoBatchUpload(BaseModel):
+    photos: List[PhotoUpload] = Field(min_length=1, max_length=MAX_BATCH_PHOTOS)
+
 class PhotoResponse(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str
     user_id: str
-    image_base64: str
+    image_url: str
     category: str
     tags: List[str]
     description: str
@@ -89,6 +142,12 @@ class MessageResponse(BaseModel):
     created_at: str
     is_read: bool
 
+class FriendRequestBatch(BaseModel):
+    request_ids: List[str] = Field(min_length=1, max_length=50)
+
+class MarkReadBatch(BaseModel):
+    user_ids: Optional[List[str]] = None  # None marks every conversation read
+
 class ReportCreate(BaseModel):
     reported_user_id: Optional[str] = None
     reported_photo_id: Optional[str] = None
@@ -99,11 +158,19 @@ class BlockUser(BaseModel):
 
 # ==================== HELPERS ====================
 
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+BUSY_MESSAGE = "We are very busy right now. Please try again in a moment!"
+
+async def hash_password(password: str) -> str:
+    try:
+        return await password_hasher.hash(password)
+    except HashingOverloaded:
+        raise HTTPException(status_code=503, detail=BUSY_MESSAGE, headers={"Retry-After": "5"})
 
-def verify_password(password: str, hashed: str) -> bool:
-    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+async def verify_password(password: str, hashed: str) -> bool:
+    try:
+        return await password_hasher.verify(password, hashed)
+    except HashingOverloaded:
+        raise HTTPException(status_code=503, detail=BUSY_MESSAGE, headers={"Retry-After": "5"})
 
 def create_token(user_id: str, nickname: str) -> str:
     return jwt.encode(
@@ -112,68 +179,283 @@ def create_token(user_id: str, nickname: str) -> str:
     )
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return await authenticate_token(credentials.credentials)
+
+async def authenticate_token(token: str) -> dict:
     try:
-        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=["HS256"])
-        user = await db.users.find_one({"id": payload["user_id"]}, {"_id": 0})
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
-        return user
+        payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
+        user = principal_cache.get(payload["user_id"])
+        if user is None:
+            user = await db.users.find_one({"id": payload["user_id"]}, PRINCIPAL_PROJECTION)
+            if not user:
+                raise HTTPException(status_code=401, detail="User not found")
+            principal_cache.set(user["id"], user)
+        return dict(user)
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-async def analyze_image_with_ai(image_base64: str) -> dict:
-    """Analyze image using OpenAI GPT-4o for content moderation and categorization"""
+PUBLIC_PROFILE_PROJECTION = {"_id": 0, "id": 1, "nickname": 1, "display_name": 1, "avatar_url": 1, "created_at": 1}
+
+class UserLoader:
+    """Batches public-profile lookups into one $in query and memoizes them per request"""
+    
+    def __init__(self, database):
+        self.db = database
+        self._cache = {}
+    
+    async def load_many(self, user_ids) -> dict:
+        missing = {uid for uid in user_ids if uid not in self._cache}
+        if missing:
+            users = await self.db.users.find(
+                {"id": {"$in": list(missing)}}, PUBLIC_PROFILE_PROJECTION
+            ).to_list(None)
+            found = {u["id"]: u for u in users}
+            for uid in missing:
+                self._cache[uid] = found.get(uid)
+        return {uid: self._cache[uid] for uid in user_ids if self._cache.get(uid)}
+    
+    async def get(self, user_id: str) -> Optional[dict]:
+        return (await self.load_many([user_id])).get(user_id)
+
+def public_profile(user: dict, include_created_at: bool = False) -> dict:
+    profile = {
+        "id": user["id"],
+        "nickname": user.get("display_name", user["nickname"]),
+        "avatar_url": user["avatar_url"]
+    }
+    if include_created_at:
+        profile["created_at"] = user["created_at"]
+    return profile
+
+async def get_user_loader() -> UserLoader:
+    return UserLoader(db)
+
+PHOTO_LIST_PROJECTION = {
+    "_id": 0, "ai_analysis": 0, "image_base64": 0, "image_key": 0, "image_variants": 0, "image_layout": 0, "blob_keys": 0
+}
+
+# Pending photos are not moderated yet, so their image URLs are signed and
+# only handed to the owner
+PENDING_IMAGE_URL_TTL_SECONDS = int(os.environ.get("PENDING_IMAGE_URL_TTL_SECONDS", "3600"))
+
+def image_signature(photo_id: str, expires: int) -> str:
+    return hmac.new(JWT_SECRET.encode("utf-8"), f"image:{photo_id}:{expires}".encode("utf-8"), hashlib.sha256).hexdigest()
+
+def photo_image_url(photo_id: str, size: str = ORIGINAL, expires: Optional[int] = None) -> str:
+    params = {} if size == ORIGINAL else {"size": size}
+    if expires:
+        params.update(expires=expires, signature=image_signature(photo_id, expires))
+    url = f"/api/photos/{photo_id}/image"
+    return f"{url}?{urlencode(params)}" if params else url
+
+def with_image_urls(photo: dict) -> dict:
+    """List views get the tile-sized variant, the original stays available on demand"""
+    expires = int(time.time()) + PENDING_IMAGE_URL_TTL_SECONDS if photo.get("status") == "pending" else None
+    photo["thumbnail_url"] = photo_image_url(photo["id"], "thumb", expires)
+    photo["image_url"] = photo_image_url(photo["id"], "medium", expires)
+    photo["full_image_url"] = photo_image_url(photo["id"], expires=expires)
+    return photo
+
+# Marks photos whose image is in the blob store with variants; those without
+# it are found by migrate_photo_images through an index
+IMAGE_LAYOUT = 1
+
+async def store_image(image_bytes: bytes) -> dict:
+    """Store the original and its derivatives, returning the photo document fields that reference them"""
+    fields = {
+        "image_layout": IMAGE_LAYOUT,
+        "image_key": await shared_blobs.put(image_bytes),
+        "image_content_type": sniff_content_type(image_bytes) or "application/octet-stream",
+        "image_size": len(image_bytes),
+        "image_variants": {},
+    }
     try:
-        chat = LlmChat(
-            api_key=EMERGENT_LLM_KEY,
-            session_id=f"analyze-{uuid.uuid4()}",
-            system_message="""You are an image analyzer for FriendSnap, an app for adults with intellectual disabilities.
-            Your job is to:
-            1. Check if the image contains any people (faces, bodies, or identifiable human features). Famous people/celebrities are allowed.
-            2. Identify the main subject/category of the image
-            3. Extract relevant tags for matching users with similar interests
-            
-            Respond in JSON format:
-            {
-                "contains_people": true/false,
-                "is_famous_person": true/false (only if contains_people is true),
-                "category": "one of: animals, nature, food, sports, music, art, colors, objects, places, other",
-                "tags": ["tag1", "tag2", "tag3"],
-                "description": "brief description in simple language"
-            }"""
-        ).with_model("openai", "gpt-4o")
-        
-        image_content = ImageContent(image_base64=image_base64)
-        user_message = UserMessage(
-            text="Analyze this image. Check if it contains people and categorize it.",
-            image_contents=[image_content]
-        )
-        
-        response = await chat.send_message(user_message)
-        
-        # Parse JSON response
-        import json
-        # Clean response - remove markdown code blocks if present
-        clean_response = response.strip()
-        if clean_response.startswith("```"):
-            clean_response = clean_response.split("```")[1]
-            if clean_response.startswith("json"):
-                clean_response = clean_response[4:]
-        
-        result = json.loads(clean_response)
-        return result
+        variants = await asyncio.to_thread(make_variants, image_bytes)
     except Exception as e:
-        logger.error(f"AI analysis error: {e}")
-        # Default safe response - allow image but flag for review
-        return {
-            "contains_people": False,
-            "is_famous_person": False,
-            "category": "other",
-            "tags": ["unanalyzed"],
-            "description": "Image pending review"
-        }
+        # Undecodable by Pillow: serve the original for every size
+        logger.error(f"Could not create image variants: {e}")
+        variants = {}
+    try:
+        for name, variant in variants.items():
+            fields["image_variants"][name] = {
+                "key": await shared_blobs.put(variant["data"]),
+                "content_type": variant["content_type"],
+                "size": len(variant["data"]),
+                "width": variant["width"],
+                "height": variant["height"],
+            }
+    except Exception:
+        # No photo will reference what was stored so far
+        await shared_blobs.release([fields["image_key"]] + [v["key"] for v in fields["image_variants"].values()])
+        raise
+    fields["blob_keys"] = [fields["image_key"]] + [v["key"] for v in fields["image_variants"].values()]
+    return fields
+
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+# Longest edge of stored and analyzed photos, larger uploads are scaled down
+MAX_IMAGE_EDGE = int(os.environ.get("MAX_IMAGE_EDGE", "1600"))
+# Batch uploads: photos checked and stored at once
+UPLOAD_CONCURRENCY = int(os.environ.get("UPLOAD_CONCURRENCY", "4"))
+# Base64 length of the largest allowed upload
+MAX_UPLOAD_BASE64_CHARS = (MAX_UPLOAD_BYTES + 2) // 3 * 4
+# Room for the multipart boundaries or JSON syntax and the category/description fields
+UPLOAD_OVERHEAD_BYTES = 64 * 1024
+TOO_BIG_MESSAGE = "This photo is too big. Please choose a smaller one!"
+
+def decode_image(image_base64: str) -> bytes:
+    """Decode an uploaded base64 image (optionally a data URL), rejecting anything that isn't an image"""
+    if image_base64.startswith("data:"):
+        image_base64 = image_base64.split(",", 1)[-1]
+    if len(image_base64) > MAX_UPLOAD_BASE64_CHARS:
+        raise HTTPException(status_code=413, detail=TOO_BIG_MESSAGE)
+    try:
+        data = base64.b64decode(image_base64, validate=True)
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="We could not read this photo. Please try another one!")
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=TOO_BIG_MESSAGE)
+    if not sniff_content_type(data):
+        raise HTTPException(status_code=400, detail="Please choose an image file!")
+    return data
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+def encode_cursor(doc: dict) -> str:
+    """Opaque keyset cursor pointing just past doc in (created_at, id) order"""
+    raw = json.dumps([doc["created_at"], doc["id"]]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        created_at, doc_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return str(created_at), str(doc_id)
+    except (ValueError, TypeError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def before_cursor(cursor: Optional[str]) -> dict:
+    """Filter for documents strictly older than the cursor in (created_at, id) descending order"""
+    if not cursor:
+        return {}
+    created_at, doc_id = decode_cursor(cursor)
+    return {"$or": [
+        {"created_at": {"$lt": created_at}},
+        {"created_at": created_at, "id": {"$lt": doc_id}}
+    ]}
+
+def set_next_cursor(response: Response, page: list, limit: int) -> None:
+    """A full page may have more behind it; the body stays a plain list for existing clients"""
+    if len(page) == limit:
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(page[-1])
+
+VIEW_CACHE_CONTROL = "private, no-cache"
+
+def not_modified(request: Request, response: Response, *etags: str) -> Optional[Response]:
+    """A 304 when If-None-Match holds one of the current ETags. Otherwise tags
+    the response with the first one and returns None."""
+    if_none_match = request.headers.get("if-none-match", "")
+    for etag in etags:
+        if if_none_match and view_versions.matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": VIEW_CACHE_CONTROL})
+    response.headers["ETag"] = etags[0]
+    response.headers["Cache-Control"] = VIEW_CACHE_CONTROL
+    return None
+
+def parse_range(range_header: str, size: int):
+    """Parse a single 'bytes=start-end' range into inclusive offsets, None if it should be ignored"""
+    unit, _, spec = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    start_s, _, end_s = spec.strip().partition("-")
+    try:
+        if start_s:
+            start = int(start_s)
+            end = int(end_s) if end_s else size - 1
+        else:
+            start = max(size - int(end_s), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    return start, min(end, size - 1)
+
+# Tag of photos approved without a model analysis; says nothing about interests
+UNANALYZED_TAG = "unanalyzed"
+
+FALLBACK_ANALYSIS = {
+    "contains_people": False,
+    "is_famous_person": False,
+    "category": "other",
+    "tags": [UNANALYZED_TAG],
+    "description": "Image pending review"
+}
+
+async def analyze_image_with_ai(image_base64: str, image_bytes: Optional[bytes] = None) -> dict:
+    """Analyze image using OpenAI GPT-4o for content moderation and categorization.
+    The result is stored in the moderation cache. Uploads look the cache up
+    before queueing (prepare_photo), so this only runs on a miss.
+    Raises when the model call fails, times out or the circuit is open;
+    callers fall back to FALLBACK_ANALYSIS."""
+    if image_bytes is None:
+        image_bytes = base64.b64decode(image_base64.split(",", 1)[-1])
+    
+    started = time.perf_counter()
+    try:
+        result = await moderation_client.analyze(image_base64)
+    except CircuitOpen:
+        metrics.llm_request_duration.observe(time.perf_counter() - started, "circuit_open")
+        raise
+    except asyncio.TimeoutError:
+        metrics.llm_request_duration.observe(time.perf_counter() - started, "timeout")
+        raise
+    except Exception:
+        metrics.llm_request_duration.observe(time.perf_counter() - started, "error")
+        raise
+    metrics.llm_request_duration.observe(time.perf_counter() - started, "ok")
+    await moderation_cache.store(image_bytes, result)
+    return result
+
+async def request_image_analysis(image_base64: str) -> dict:
+    """One GPT-4o call. Raises on any failure, including unparseable output."""
+    chat = LlmChat(
+        api_key=EMERGENT_LLM_KEY,
+        session_id=f"analyze-{uuid.uuid4()}",
+        system_message="""You are an image analyzer for FriendSnap, an app for adults with intellectual disabilities.
+        Your job is to:
+        1. Check if the image contains any people (faces, bodies, or identifiable human features). Famous people/celebrities are allowed.
+        2. Identify the main subject/category of the image
+        3. Extract relevant tags for matching users with similar interests
+        
+        Respond in JSON format:
+        {
+            "contains_people": true/false,
+            "is_famous_person": true/false (only if contains_people is true),
+            "category": "one of: animals, nature, food, sports, music, art, colors, objects, places, other",
+            "tags": ["tag1", "tag2", "tag3"],
+            "description": "brief description in simple language"
+        }"""
+    ).with_model("openai", "gpt-4o")
+    
+    image_content = ImageContent(image_base64=image_base64)
+    user_message = UserMessage(
+        text="Analyze this image. Check if it contains people and categorize it.",
+        image_contents=[image_content]
+    )
+    
+    response = await chat.send_message(user_message)
+    
+    # Parse JSON response
+    # Clean response - remove markdown code blocks if present
+    clean_response = response.strip()
+    if clean_response.startswith("```"):
+        clean_response = clean_response.split("```")[1]
+        if clean_response.startswith("json"):
+            clean_response = clean_response[4:]
+    
+    result = json.loads(clean_response)
+    return result
 
 # ==================== AUTH ROUTES ====================
 
@@ -190,12 +472,15 @@ async def register(user: UserCreate):
         "nickname": user.nickname.lower(),
         "display_name": user.nickname,
         "avatar_url": user.avatar_url,
-        "password_hash": hash_password(user.password),
+        "password_hash": await hash_password(user.password),
         "created_at": datetime.now(timezone.utc).isoformat(),
-        "blocked_users": [],
         "is_active": True
     }
-    await db.users.insert_one(user_doc)
+    try:
+        await db.users.insert_one(user_doc)
+    except DuplicateKeyError:
+        # Lost a race with another registration of the same nickname
+        raise HTTPException(status_code=400, detail="This nickname is already taken. Try another one!")
     
     token = create_token(user_id, user.nickname)
     return {
@@ -211,9 +496,22 @@ async def register(user: UserCreate):
 @api_router.post("/auth/login")
 async def login(credentials: UserLogin):
     user = await db.users.find_one({"nickname": credentials.nickname.lower()}, {"_id": 0})
-    if not user or not verify_password(credentials.password, user["password_hash"]):
+    if not user or not await verify_password(credentials.password, user["password_hash"]):
         raise HTTPException(status_code=401, detail="Wrong nickname or password. Try again!")
     
+    # Upgrade hashes made with a different cost now that we have the password.
+    # Best effort: under load the login goes ahead and the next one upgrades.
+    if password_hasher.needs_rehash(user["password_hash"]):
+        try:
+            new_hash = await password_hasher.hash(credentials.password)
+        except HashingOverloaded:
+            new_hash = None
+        if new_hash:
+            await db.users.update_one(
+                {"id": user["id"], "password_hash": user["password_hash"]},
+                {"$set": {"password_hash": new_hash}}
+            )
+    
     token = create_token(user["id"], user["nickname"])
     return {
         "token": token,
@@ -236,160 +534,572 @@ async def get_me(current_user: dict = Depends(get_current_user)):
 
 # ==================== PHOTO ROUTES ====================
 
-@api_router.post("/photos")
-async def upload_photo(photo: PhotoUpload, current_user: dict = Depends(get_current_user)):
-    """Upload a photo with AI moderation"""
+PEOPLE_REJECTION_MESSAGE = "This photo seems to have a person in it. Please share photos of things you like instead!"
+
+def is_rejected(analysis: dict) -> bool:
+    # Photos of people are not allowed, famous people are fine
+    return analysis.get("contains_people", False) and not analysis.get("is_famous_person", False)
+
+def match_score(shared: dict) -> int:
+    """Interest match score from find_matches' shared tags and categories"""
+    return len(shared["tags"]) * similarity.TAG_WEIGHT + len(shared["categories"]) * similarity.CATEGORY_WEIGHT
+
+async def fan_out_photo(photo: dict) -> None:
+    """Push a newly approved photo to its owner's, friends' and the best interest-matched users' timelines"""
+    owner_id = photo["user_id"]
+    hidden = await block_graph.hidden_ids(owner_id)
+    # Friends first, so they are kept if the fan-out is capped
+    friend_ids = await friendships.friend_ids(db, owner_id)
+    matches = await interest_index.find_matches(db, owner_id, exclude=hidden)
+    # Only users sharing a real tag; a category alone is too broad
+    scored = []
+    for uid, shared in matches.items():
+        tags = shared["tags"] - {UNANALYZED_TAG}
+        if tags:
+            scored.append((match_score({"tags": tags, "categories": shared["categories"]}), uid))
+    scored.sort(reverse=True)
+    interested = [uid for _, uid in scored[:timelines.MAX_INTEREST_RECIPIENTS]]
+    recipients = [owner_id, *(fid for fid in friend_ids if fid not in hidden), *interested]
+    written = await timelines.push(db, photo, recipients)
+    await view_versions.bump(db, written, view_versions.FEED)
+
+async def apply_moderation(photo_id: str, analysis: dict) -> None:
+    """Approve or reject a pending photo and notify its owner"""
+    if is_rejected(analysis):
+        photo = await db.photos.find_one_and_update(
+            {"id": photo_id, "status": "pending"},
+            {"$set": {"status": "rejected", "is_approved": False, "rejection_reason": PEOPLE_REJECTION_MESSAGE,
+                      "ai_analysis": analysis, "blob_keys": []}},
+            projection={"_id": 0, "user_id": 1, "blob_keys": 1}
+        )
+        if photo:
+            # Don't keep images of people around
+            await shared_blobs.release(photo.get("blob_keys", []))
+    else:
+        pending = await db.photos.find_one({"id": photo_id, "status": "pending"}, {"_id": 0, "category": 1, "description": 1})
+        photo = pending and await db.photos.find_one_and_update(
+            {"id": photo_id, "status": "pending"},
+            {"$set": {
+                "status": "approved",
+                "is_approved": True,
+                "category": analysis.get("category", pending.get("category") or "other"),
+                "tags": analysis.get("tags", []),
+                "description": pending.get("description") or analysis.get("description", ""),
+                "ai_analysis": analysis
+            }},
+            projection={"_id": 0, "id": 1, "user_id": 1, "tags": 1, "category": 1, "created_at": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if photo:
+            await interest_index.add_photo(db, photo)
+            await fan_out_photo(photo)
+            # The global feed and everyone's suggestions may change
+            await view_versions.bump(db, [view_versions.GLOBAL], view_versions.PHOTOS)
     
-    # Analyze image with AI
-    analysis = await analyze_image_with_ai(photo.image_base64)
+    if photo:
+        await broker.publish(user_channel(photo["user_id"]), {
+            "type": "photo_moderated",
+            "photo_id": photo_id,
+            "status": "rejected" if is_rejected(analysis) else "approved"
+        })
+
+async def moderate_photo_job(payload: dict) -> None:
+    """Moderation queue handler. Raising makes the queue retry with backoff."""
+    photo = await db.photos.find_one({"id": payload["photo_id"], "status": "pending"}, {"_id": 0, "image_key": 1})
+    if not photo:
+        return  # deleted or already moderated
+    image_bytes = await blob_store.read(photo["image_key"])
+    try:
+        analysis = await analyze_image_with_ai(base64.b64encode(image_bytes).decode("ascii"), image_bytes)
+    except Exception as e:
+        logger.error(f"AI analysis error: {e}")
+        raise
+    await apply_moderation(payload["photo_id"], analysis)
+
+async def moderation_gave_up(payload: dict, error: Exception) -> None:
+    # Same as a failed synchronous analysis: allow the image but flag it for review
+    await apply_moderation(payload["photo_id"], dict(FALLBACK_ANALYSIS))
+
+moderation_queue = JobQueue(
+    db,
+    "moderation_jobs",
+    handler=moderate_photo_job,
+    on_failure=moderation_gave_up,
+    workers=int(os.environ.get("MODERATION_WORKERS", "4")),
+    max_attempts=int(os.environ.get("MODERATION_MAX_ATTEMPTS", "5")),
+    backoff_base=float(os.environ.get("MODERATION_RETRY_BASE_SECONDS", "2")),
+)
+
+def photo_response(photo_doc: dict) -> dict:
+    return with_image_urls({
+        "id": photo_doc["id"],
+        "user_id": photo_doc["user_id"],
+        "category": photo_doc["category"],
+        "tags": photo_doc["tags"],
+        "description": photo_doc["description"],
+        "created_at": photo_doc["created_at"],
+        "is_approved": photo_doc["is_approved"],
+        "status": photo_doc["status"]
+    })
+
+UPLOAD_REQUEST_BODY = {
+    "required": True,
+    "content": {
+        "multipart/form-data": {"schema": {
+            "type": "object",
+            "required": ["file"],
+            "properties": {
+                "file": {"type": "string", "format": "binary"},
+                "category": {"type": "string"},
+                "description": {"type": "string"},
+            },
+        }},
+        "application/json": {"schema": PhotoUpload.model_json_schema()},
+    },
+}
+
+def limited_stream(request: Request, limit: int):
+    """The request body as it arrives, rejected with 413 once it passes limit bytes"""
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > limit:
+        raise HTTPException(status_code=413, detail=TOO_BIG_MESSAGE)
     
-    # Check if image contains people (not famous)
-    if analysis.get("contains_people", False) and not analysis.get("is_famous_person", False):
-        raise HTTPException(
-            status_code=400, 
-            detail="This photo seems to have a person in it. Please share photos of things you like instead!"
-        )
+    async def stream():
+        received = 0
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > limit:
+                raise HTTPException(status_code=413, detail=TOO_BIG_MESSAGE)
+            yield chunk
+    return stream()
+
+async def read_json_body(request: Request, max_images: int = 1):
+    """Parse a JSON upload of up to max_images base64 images, enforcing the size limit as it arrives"""
+    limit = MAX_UPLOAD_BASE64_CHARS * max_images + UPLOAD_OVERHEAD_BYTES
+    return json.loads(b"".join([chunk async for chunk in limited_stream(request, limit)]))
+
+async def read_json_upload(request: Request) -> tuple:
+    try:
+        photo = PhotoUpload.model_validate(await read_json_body(request))
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="We could not read this photo. Please try another one!")
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+    return decode_image(photo.image_base64), photo.category, photo.description
+
+async def parse_multipart(request: Request, max_files: int = 1):
+    """Stream a multipart upload into spooled temp files, enforcing the size limit as it arrives.
+    The caller closes the returned form."""
+    stream = limited_stream(request, MAX_UPLOAD_BYTES * max_files + UPLOAD_OVERHEAD_BYTES)
+    try:
+        return await MultiPartParser(request.headers, stream, max_files=max_files, max_fields=2).parse()
+    except MultiPartException:
+        raise HTTPException(status_code=400, detail="We could not read this photo. Please try another one!")
+
+async def read_image_part(upload) -> bytes:
+    if upload is None or isinstance(upload, str):
+        raise HTTPException(status_code=400, detail="Please choose an image file!")
+    # Check the magic bytes before reading the rest
+    if not sniff_content_type(await upload.read(16)):
+        raise HTTPException(status_code=400, detail="Please choose an image file!")
+    await upload.seek(0)
+    image_bytes = await upload.read()
+    if len(image_bytes) > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=TOO_BIG_MESSAGE)
+    return image_bytes
+
+async def read_multipart_upload(request: Request) -> tuple:
+    form = await parse_multipart(request)
+    try:
+        image_bytes = await read_image_part(form.get("file"))
+        return image_bytes, str(form.get("category", "")), str(form.get("description", ""))
+    finally:
+        await form.close()
+
+def is_multipart(request: Request) -> bool:
+    return request.headers.get("content-type", "").startswith("multipart/form-data")
+
+async def prepare_photo(user_id: str, image_bytes: bytes, category: str, description: str) -> tuple:
+    """Normalize the image, check the moderation cache and store it. Returns the
+    pending photo document and the cached analysis, if any."""
+    # Only the normalized image is analyzed and kept, never the raw upload
+    try:
+        image_bytes = await asyncio.to_thread(normalize_image, image_bytes, MAX_IMAGE_EDGE)
+    except ValueError as e:
+        logger.warning(f"Rejected upload: {e}")
+        raise HTTPException(status_code=400, detail="We could not read this photo. Please try another one!")
+
+    analysis = await moderation_cache.lookup(image_bytes)
+    if analysis is not None and is_rejected(analysis):
+        raise HTTPException(status_code=400, detail=PEOPLE_REJECTION_MESSAGE)
     
-    photo_id = str(uuid.uuid4())
+    image_fields = await store_image(image_bytes)
     photo_doc = {
-        "id": photo_id,
-        "user_id": current_user["id"],
-        "image_base64": photo.image_base64,
-        "category": analysis.get("category", photo.category or "other"),
-        "tags": analysis.get("tags", []),
-        "description": photo.description or analysis.get("description", ""),
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        **image_fields,
+        "category": category or "other",
+        "tags": [],
+        "description": description,
         "created_at": datetime.now(timezone.utc).isoformat(),
-        "is_approved": True,
-        "ai_analysis": analysis
+        "is_approved": False,
+        "status": "pending"
     }
+    return photo_doc, analysis
+
+@api_router.post("/photos", openapi_extra={"requestBody": UPLOAD_REQUEST_BODY})
+async def upload_photo(request: Request, current_user: dict = Depends(get_current_user)):
+    """Upload a photo, either as a multipart file or as base64 in JSON.
+    Known images are moderated right away from the cache, everything else
+    is stored as pending and moderated in the background."""
+    if is_multipart(request):
+        image_bytes, category, description = await read_multipart_upload(request)
+    else:
+        image_bytes, category, description = await read_json_upload(request)
+    
+    photo_doc, analysis = await prepare_photo(current_user["id"], image_bytes, category, description)
     await db.photos.insert_one(photo_doc)
     
-    return {
-        "id": photo_id,
-        "user_id": current_user["id"],
-        "image_base64": photo.image_base64,
-        "category": photo_doc["category"],
-        "tags": photo_doc["tags"],
-        "description": photo_doc["description"],
-        "created_at": photo_doc["created_at"],
-        "is_approved": True
-    }
+    if analysis is not None:
+        await apply_moderation(photo_doc["id"], analysis)
+        photo_doc = await db.photos.find_one({"id": photo_doc["id"]}, {"_id": 0})
+    else:
+        await moderation_queue.enqueue({"photo_id": photo_doc["id"]})
+    
+    return photo_response(photo_doc)
+
+BATCH_UPLOAD_REQUEST_BODY = {
+    "required": True,
+    "content": {
+        "multipart/form-data": {"schema": {
+            "type": "object",
+            "required": ["file"],
+            "properties": {
+                "file": {"type": "array", "items": {"type": "string", "format": "binary"}, "maxItems": MAX_BATCH_PHOTOS},
+                "category": {"type": "string"},
+                "description": {"type": "string"},
+            },
+        }},
+        "application/json": {"schema": PhotoBatchUpload.model_json_schema()},
+    },
+}
+
+async def read_batch_upload(request: Request) -> list:
+    """Per item either (image_bytes, category, description) or the HTTPException that rejected it"""
+    if not is_multipart(request):
+        try:
+            batch = PhotoBatchUpload.model_validate(await read_json_body(request, MAX_BATCH_PHOTOS))
+        except json.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="We could not read these photos. Please try again!")
+        except ValidationError as e:
+            raise RequestValidationError(e.errors())
+        items = []
+        for photo in batch.photos:
+            try:
+                items.append((decode_image(photo.image_base64), photo.category, photo.description))
+            except HTTPException as e:
+                items.append(e)
+        return items
+    
+    form = await parse_multipart(request, max_files=MAX_BATCH_PHOTOS)
+    try:
+        uploads = form.getlist("file")
+        if not uploads:
+            raise HTTPException(status_code=400, detail="Please choose an image file!")
+        category, description = str(form.get("category", "")), str(form.get("description", ""))
+        items = []
+        for upload in uploads:
+            try:
+                items.append((await read_image_part(upload), category, description))
+            except HTTPException as e:
+                items.append(e)
+        return items
+    finally:
+        await form.close()
+
+@api_router.post("/photos/batch", openapi_extra={"requestBody": BATCH_UPLOAD_REQUEST_BODY})
+async def upload_photos(request: Request, current_user: dict = Depends(get_current_user)):
+    """Upload several photos at once. Images are checked and stored concurrently;
+    the result has one entry per photo, in order: {"photo": ...} or {"error": ...}."""
+    items = await read_batch_upload(request)
+    semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+    
+    async def prepare(item):
+        if isinstance(item, HTTPException):
+            return item
+        async with semaphore:
+            try:
+                return await prepare_photo(current_user["id"], *item)
+            except HTTPException as e:
+                return e
+            except Exception as e:
+                # One broken photo doesn't fail the others
+                logger.exception(f"Could not prepare batch photo: {e}")
+                return HTTPException(status_code=500, detail="We could not upload this photo. Please try again!")
+    
+    prepared = await asyncio.gather(*(prepare(item) for item in items))
+    ready = [p for p in prepared if not isinstance(p, HTTPException)]
+    if ready:
+        await db.photos.insert_many([photo_doc for photo_doc, _ in ready])
+        await moderation_queue.enqueue_many([
+            {"photo_id": photo_doc["id"]} for photo_doc, analysis in ready if analysis is None
+        ])
+        cached = [(photo_doc["id"], analysis) for photo_doc, analysis in ready if analysis is not None]
+        if cached:
+            await asyncio.gather(*(apply_moderation(photo_id, analysis) for photo_id, analysis in cached))
+            moderated = await db.photos.find({"id": {"$in": [photo_id for photo_id, _ in cached]}}, {"_id": 0}).to_list(None)
+            by_id = {photo["id"]: photo for photo in moderated}
+            ready = [(by_id.get(photo_doc["id"], photo_doc), analysis) for photo_doc, analysis in ready]
+    
+    docs = iter(photo_doc for photo_doc, _ in ready)
+    return [
+        {"error": p.detail} if isinstance(p, HTTPException) else {"photo": photo_response(next(docs))}
+        for p in prepared
+    ]
+
+@api_router.get("/photos/{photo_id}/status")
+async def get_photo_status(photo_id: str, current_user: dict = Depends(get_current_user)):
+    """Moderation state of an own photo: pending, approved or rejected"""
+    photo = await db.photos.find_one(
+        {"id": photo_id, "user_id": current_user["id"]},
+        {"_id": 0, "status": 1, "is_approved": 1, "rejection_reason": 1}
+    )
+    if not photo:
+        raise HTTPException(status_code=404, detail="Photo not found")
+    status = photo.get("status", "approved" if photo.get("is_approved") else "pending")
+    return {"id": photo_id, "status": status, "detail": photo.get("rejection_reason")}
 
 @api_router.get("/photos/mine")
-async def get_my_photos(current_user: dict = Depends(get_current_user)):
-    """Get current user's photos"""
+async def get_my_photos(
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=200),
+    current_user: dict = Depends(get_current_user)
+):
+    """Get current user's photos, newest first, including ones still being moderated"""
     photos = await db.photos.find(
-        {"user_id": current_user["id"], "is_approved": True}, 
-        {"_id": 0, "ai_analysis": 0}
-    ).sort("created_at", -1).to_list(100)
-    return photos
+        {"user_id": current_user["id"], "status": {"$ne": "rejected"}, **before_cursor(cursor)}, 
+        PHOTO_LIST_PROJECTION
+    ).sort(NEWEST_FIRST).limit(limit).to_list(limit)
+    set_next_cursor(response, photos, limit)
+    return [with_image_urls(photo) for photo in photos]
 
 @api_router.get("/photos/feed")
-async def get_feed(current_user: dict = Depends(get_current_user)):
+async def get_feed(
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=100),
+    current_user: dict = Depends(get_current_user),
+    users: UserLoader = Depends(get_user_loader)
+):
     """Get photos from friends and suggested users"""
-    blocked_users = current_user.get("blocked_users", [])
+    # A timeline page only changes with the user's feed version, the global
+    # feed also with every approval or deletion, and both with the blocks
+    # version the hidden set is read under
+    versions = await view_versions.get(db, current_user["id"])
+    feed_version = versions["user"].get(view_versions.FEED, 0)
+    blocks_version = versions["user"].get(view_versions.BLOCKS, 0)
+    timeline_etag = view_versions.etag("feed", current_user["id"], feed_version, blocks_version, cursor, limit)
+    global_etag = view_versions.etag(
+        "global feed", current_user["id"], feed_version, blocks_version,
+        versions["global"].get(view_versions.PHOTOS, 0), cursor, limit
+    )
+    cached = not_modified(request, response, timeline_etag, global_etag)
+    if cached:
+        return cached
     
-    # Get photos excluding blocked users
-    photos = await db.photos.find(
-        {"is_approved": True, "user_id": {"$nin": blocked_users}},
-        {"_id": 0, "ai_analysis": 0}
-    ).sort("created_at", -1).to_list(50)
+    hidden = await block_graph.hidden_ids(current_user["id"], blocks_version)
+    entries = await timelines.read_page(
+        db, current_user["id"], limit, before=decode_cursor(cursor) if cursor else None, exclude_owners=hidden
+    )
+    if entries is None:
+        # New users: latest photos from everyone, excluding blocked and blocking users
+        photos = await db.photos.find(
+            {"is_approved": True, "user_id": {"$nin": list(hidden)}, **before_cursor(cursor)},
+            PHOTO_LIST_PROJECTION
+        ).sort(NEWEST_FIRST).limit(limit).to_list(limit)
+        set_next_cursor(response, photos, limit)
+        response.headers["ETag"] = global_etag
+    else:
+        found = await db.photos.find(
+            {"id": {"$in": [entry["id"] for entry in entries]}, "is_approved": True}, PHOTO_LIST_PROJECTION
+        ).to_list(limit)
+        by_id = {photo["id"]: photo for photo in found}
+        photos = [by_id[entry["id"]] for entry in entries if entry["id"] in by_id]
+        # Page by timeline entries so a deleted photo doesn't end the feed early
+        set_next_cursor(response, entries, limit)
     
     # Enrich with user info
+    owners = await users.load_many({photo["user_id"] for photo in photos})
     for photo in photos:
-        user = await db.users.find_one({"id": photo["user_id"]}, {"_id": 0, "password_hash": 0, "blocked_users": 0})
-        if user:
-            photo["user"] = {
-                "id": user["id"],
-                "nickname": user.get("display_name", user["nickname"]),
-                "avatar_url": user["avatar_url"]
-            }
+        with_image_urls(photo)
+        if photo["user_id"] in owners:
+            photo["user"] = public_profile(owners[photo["user_id"]])
     
     return photos
 
+@api_router.get("/photos/{photo_id}/image")
+async def get_photo_image(
+    photo_id: str,
+    request: Request,
+    size: str = ORIGINAL,
+    expires: Optional[int] = None,
+    signature: str = ""
+):
+    """Stream a photo's bytes. Unauthenticated so it can be used directly as an <img> src;
+    photos still being moderated need the signed URL given to their owner."""
+    if size != ORIGINAL and size not in VARIANT_SIZES:
+        raise HTTPException(status_code=400, detail=f"Unknown image size: {size}")
+    signed = bool(expires and expires > time.time()
+                  and hmac.compare_digest(signature, image_signature(photo_id, expires)))
+    photo = await db.photos.find_one(
+        {"id": photo_id, "$or": [{"is_approved": True}, {"status": "pending"}] if signed else [{"is_approved": True}]},
+        {"_id": 0, "image_key": 1, "image_content_type": 1, "image_variants": 1, "image_base64": 1, "is_approved": 1}
+    )
+    if not photo:
+        raise HTTPException(status_code=404, detail="Photo not found")
+    
+    # Photos stored before the blob store existed are served from the document
+    if not photo.get("image_key"):
+        data = base64.b64decode(photo.get("image_base64", ""))
+        return Response(content=data, media_type=sniff_content_type(data) or "application/octet-stream")
+    
+    # Fall back to the original while variants have not been generated
+    variant = photo.get("image_variants", {}).get(size)
+    key = variant["key"] if variant else photo["image_key"]
+    media_type = variant["content_type"] if variant else photo.get("image_content_type", "application/octet-stream")
+    total = await blob_store.size(key)
+    if total is None:
+        raise HTTPException(status_code=404, detail="Photo not found")
+    
+    # Content-addressed, so the bytes behind a key never change. Pending photos
+    # may still be rejected, so shared caches must not keep them.
+    headers = {
+        "ETag": f'"{key}"',
+        "Cache-Control": "public, max-age=31536000, immutable" if photo.get("is_approved") else "private, no-store",
+        "Accept-Ranges": "bytes",
+    }
+    if key in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    
+    byte_range = parse_range(request.headers["range"], total) if "range" in request.headers else None
+    if byte_range:
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{total}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(blob_store.stream(key, start, end), status_code=206, media_type=media_type, headers=headers)
+    
+    headers["Content-Length"] = str(total)
+    return StreamingResponse(blob_store.stream(key), media_type=media_type, headers=headers)
+
 @api_router.delete("/photos/{photo_id}")
 async def delete_photo(photo_id: str, current_user: dict = Depends(get_current_user)):
     """Delete own photo"""
-    result = await db.photos.delete_one({"id": photo_id, "user_id": current_user["id"]})
-    if result.deleted_count == 0:
+    photo = await db.photos.find_one_and_delete(
+        {"id": photo_id, "user_id": current_user["id"]},
+        {"_id": 0, "user_id": 1, "tags": 1, "category": 1, "blob_keys": 1, "is_approved": 1}
+    )
+    if not photo:
         raise HTTPException(status_code=404, detail="Photo not found")
+    # Only approved photos are in the interest index and timelines
+    if photo.get("is_approved"):
+        await interest_index.remove_photo(db, photo)
+        holders = await timelines.remove_photo(db, photo_id)
+        await view_versions.bump(db, holders, view_versions.FEED)
+        await view_versions.bump(db, [view_versions.GLOBAL], view_versions.PHOTOS)
+    await shared_blobs.release(photo.get("blob_keys", []))
     return {"message": "Photo deleted"}
 
 # ==================== FRIEND MATCHING ROUTES ====================
 
 @api_router.get("/friends/suggestions")
-async def get_friend_suggestions(current_user: dict = Depends(get_current_user)):
+async def get_friend_suggestions(request: Request, response: Response, current_user: dict = Depends(get_current_user)):
     """Get friend suggestions based on similar photo interests"""
+    versions = await view_versions.get(db, current_user["id"])
+    blocks_version = versions["user"].get(view_versions.BLOCKS, 0)
+    cached = not_modified(request, response, view_versions.etag(
+        "suggestions", current_user["id"], versions["user"].get(view_versions.SUGGESTIONS, 0), blocks_version,
+        versions["global"].get(view_versions.PHOTOS, 0), versions["global"].get(view_versions.SUGGESTIONS, 0)
+    ))
+    if cached:
+        return cached
     
-    # Get current user's tags
-    my_photos = await db.photos.find({"user_id": current_user["id"]}, {"_id": 0}).to_list(100)
-    my_tags = set()
-    my_categories = set()
-    for photo in my_photos:
-        my_tags.update(photo.get("tags", []))
-        my_categories.add(photo.get("category", ""))
+    hidden = await block_graph.hidden_ids(current_user["id"], blocks_version)
+    excluded = {*hidden, *await friendships.friend_ids(db, current_user["id"])}
     
-    if not my_tags and not my_categories:
+    # Precomputed by the similarity batch job
+    ranked = await similarity.get_suggestions(db, current_user["id"])
+    if ranked is None:
+        # New since the last run: walk the posting lists of the user's tags and categories
+        matches = await interest_index.find_matches(db, current_user["id"], exclude=excluded)
+        ranked = [{
+            "user_id": uid,
+            "score": match_score(shared),
+            "shared_categories": sorted(shared["categories"])
+        } for uid, shared in matches.items()]
+    ranked = [r for r in ranked if r["user_id"] not in excluded]
+    if not ranked:
         return []
     
-    blocked_users = current_user.get("blocked_users", [])
-    
-    # Find other users with similar interests
     other_users = await db.users.find(
-        {"id": {"$ne": current_user["id"], "$nin": blocked_users}, "is_active": True},
+        {"id": {"$in": [r["user_id"] for r in ranked]}, "is_active": True},
         {"_id": 0, "password_hash": 0, "blocked_users": 0}
-    ).to_list(100)
+    ).to_list(None)
+    users_by_id = {user["id"]: user for user in other_users}
     
     suggestions = []
-    for user in other_users:
-        user_photos = await db.photos.find({"user_id": user["id"]}, {"_id": 0}).to_list(50)
-        user_tags = set()
-        user_categories = set()
-        for photo in user_photos:
-            user_tags.update(photo.get("tags", []))
-            user_categories.add(photo.get("category", ""))
+    for match in ranked:
+        user = users_by_id.get(match["user_id"])
+        if not user:
+            continue
+        shared_categories = match["shared_categories"]
+        score = match["score"]
         
-        # Calculate match score
-        shared_tags = my_tags.intersection(user_tags)
-        shared_categories = my_categories.intersection(user_categories)
+        # Create friendly interest descriptions
+        shared_interests = []
+        if shared_categories:
+            category_map = {
+                "animals": "You both like animals",
+                "nature": "You both like nature",
+                "food": "You both like food",
+                "sports": "You both like sports",
+                "music": "You both like music",
+                "art": "You both like art",
+                "colors": "You both like colors",
+                "places": "You both like places",
+                "objects": "You both like similar things"
+            }
+            for cat in shared_categories:
+                if cat in category_map:
+                    shared_interests.append(category_map[cat])
         
-        if shared_tags or shared_categories:
-            # Simple match score
-            score = len(shared_tags) * 2 + len(shared_categories) * 3
-            
-            # Create friendly interest descriptions
-            shared_interests = []
-            if shared_categories:
-                category_map = {
-                    "animals": "You both like animals",
-                    "nature": "You both like nature",
-                    "food": "You both like food",
-                    "sports": "You both like sports",
-                    "music": "You both like music",
-                    "art": "You both like art",
-                    "colors": "You both like colors",
-                    "places": "You both like places",
-                    "objects": "You both like similar things"
-                }
-                for cat in shared_categories:
-                    if cat in category_map:
-                        shared_interests.append(category_map[cat])
-            
-            suggestions.append({
-                "user": {
-                    "id": user["id"],
-                    "nickname": user.get("display_name", user["nickname"]),
-                    "avatar_url": user["avatar_url"],
-                    "created_at": user["created_at"]
-                },
-                "shared_interests": shared_interests[:3],  # Limit to 3 interests
-                "match_score": score,
-                "sample_photo": user_photos[0]["image_base64"] if user_photos else None
-            })
+        suggestions.append({
+            "user": {
+                "id": user["id"],
+                "nickname": user.get("display_name", user["nickname"]),
+                "avatar_url": user["avatar_url"],
+                "created_at": user["created_at"]
+            },
+            "shared_interests": shared_interests[:3],  # Limit to 3 interests
+            "match_score": score
+        })
     
     # Sort by match score
     suggestions.sort(key=lambda x: x["match_score"], reverse=True)
-    return suggestions[:10]  # Top 10 suggestions
+    suggestions = suggestions[:10]  # Top 10 suggestions
+    
+    # Attach one sample photo per suggested user
+    sample_photos = await db.photos.aggregate([
+        {"$match": {"user_id": {"$in": [s["user"]["id"] for s in suggestions]}, "is_approved": True}},
+        {"$sort": {"created_at": -1}},
+        {"$group": {"_id": "$user_id", "photo_id": {"$first": "$id"}}}
+    ]).to_list(None)
+    samples = {p["_id"]: photo_image_url(p["photo_id"], "thumb") for p in sample_photos}
+    for suggestion in suggestions:
+        suggestion["sample_photo_url"] = samples.get(suggestion["user"]["id"])
+    
+    return suggestions
 
 @api_router.post("/friends/request/{user_id}")
 async def send_friend_request(user_id: str, current_user: dict = Depends(get_current_user)):
@@ -397,7 +1107,10 @@ async def send_friend_request(user_id: str, current_user: dict = Depends(get_cur
     if user_id == current_user["id"]:
         raise HTTPException(status_code=400, detail="You can't add yourself as a friend!")
     
-    # Check if already friends or request pending
+    if await friendships.are_friends(db, current_user["id"], user_id):
+        raise HTTPException(status_code=400, detail="You are already friends!")
+    
+    # Check if a request is already pending
     existing = await db.friend_requests.find_one({
         "$or": [
             {"sender_id": current_user["id"], "receiver_id": user_id},
@@ -418,78 +1131,96 @@ async def send_friend_request(user_id: str, current_user: dict = Depends(get_cur
     return {"message": "Friend request sent!"}
 
 @api_router.get("/friends/requests")
-async def get_friend_requests(current_user: dict = Depends(get_current_user)):
+async def get_friend_requests(current_user: dict = Depends(get_current_user), users: UserLoader = Depends(get_user_loader)):
     """Get pending friend requests"""
+    hidden = await block_graph.hidden_ids(current_user["id"])
     requests = await db.friend_requests.find(
-        {"receiver_id": current_user["id"], "status": "pending"},
+        {"receiver_id": current_user["id"], "status": "pending", "sender_id": {"$nin": list(hidden)}},
         {"_id": 0}
     ).to_list(50)
     
     # Enrich with sender info
+    senders = await users.load_many({req["sender_id"] for req in requests})
     for req in requests:
-        sender = await db.users.find_one({"id": req["sender_id"]}, {"_id": 0, "password_hash": 0, "blocked_users": 0})
-        if sender:
-            req["sender"] = {
-                "id": sender["id"],
-                "nickname": sender.get("display_name", sender["nickname"]),
-                "avatar_url": sender["avatar_url"]
-            }
+        if req["sender_id"] in senders:
+            req["sender"] = public_profile(senders[req["sender_id"]])
     return requests
 
 @api_router.post("/friends/accept/{request_id}")
 async def accept_friend_request(request_id: str, current_user: dict = Depends(get_current_user)):
     """Accept a friend request"""
-    result = await db.friend_requests.update_one(
+    request = await db.friend_requests.find_one_and_update(
         {"id": request_id, "receiver_id": current_user["id"], "status": "pending"},
-        {"$set": {"status": "accepted"}}
+        {"$set": {"status": "accepted"}},
+        projection={"_id": 0, "sender_id": 1}
     )
-    if result.modified_count == 0:
+    if not request:
         raise HTTPException(status_code=404, detail="Request not found")
+    await friendships.add(db, request["sender_id"], current_user["id"])
+    await view_versions.bump(db, [request["sender_id"], current_user["id"]], view_versions.FRIENDS, view_versions.SUGGESTIONS)
     return {"message": "You are now friends!"}
 
+@api_router.post("/friends/accept")
+async def accept_friend_requests(batch: FriendRequestBatch, current_user: dict = Depends(get_current_user)):
+    """Accept several friend requests at once"""
+    requests = await db.friend_requests.find(
+        {"id": {"$in": batch.request_ids}, "receiver_id": current_user["id"], "status": "pending"},
+        {"_id": 0, "id": 1, "sender_id": 1}
+    ).to_list(None)
+    if requests:
+        await db.friend_requests.update_many(
+            {"id": {"$in": [req["id"] for req in requests]}, "status": "pending"},
+            {"$set": {"status": "accepted"}}
+        )
+        await friendships.add_many(db, [(req["sender_id"], current_user["id"]) for req in requests])
+        await view_versions.bump(
+            db, [current_user["id"], *(req["sender_id"] for req in requests)],
+            view_versions.FRIENDS, view_versions.SUGGESTIONS
+        )
+    accepted = {req["id"] for req in requests}
+    return {
+        "accepted": [rid for rid in batch.request_ids if rid in accepted],
+        "not_found": [rid for rid in batch.request_ids if rid not in accepted]
+    }
+
 @api_router.get("/friends/list")
-async def get_friends(current_user: dict = Depends(get_current_user)):
+async def get_friends(
+    request: Request,
+    response: Response,
+    current_user: dict = Depends(get_current_user),
+    users: UserLoader = Depends(get_user_loader)
+):
     """Get list of friends"""
-    accepted_requests = await db.friend_requests.find(
-        {"$or": [
-            {"sender_id": current_user["id"], "status": "accepted"},
-            {"receiver_id": current_user["id"], "status": "accepted"}
-        ]},
-        {"_id": 0}
-    ).to_list(100)
-    
-    friend_ids = []
-    for req in accepted_requests:
-        friend_id = req["receiver_id"] if req["sender_id"] == current_user["id"] else req["sender_id"]
-        friend_ids.append(friend_id)
-    
-    friends = []
-    for fid in friend_ids:
-        friend = await db.users.find_one({"id": fid}, {"_id": 0, "password_hash": 0, "blocked_users": 0})
-        if friend:
-            friends.append({
-                "id": friend["id"],
-                "nickname": friend.get("display_name", friend["nickname"]),
-                "avatar_url": friend["avatar_url"],
-                "created_at": friend["created_at"]
-            })
-    return friends
+    versions = await view_versions.get(db, current_user["id"])
+    blocks_version = versions["user"].get(view_versions.BLOCKS, 0)
+    cached = not_modified(request, response, view_versions.etag(
+        "friends", current_user["id"], versions["user"].get(view_versions.FRIENDS, 0), blocks_version
+    ))
+    if cached:
+        return cached
+    
+    hidden = await block_graph.hidden_ids(current_user["id"], blocks_version)
+    friend_ids = [fid for fid in await friendships.friend_ids(db, current_user["id"], limit=100) if fid not in hidden]
+    
+    friends = await users.load_many(friend_ids)
+    return [public_profile(friends[fid], include_created_at=True) for fid in friend_ids if fid in friends]
 
 # ==================== CHAT ROUTES ====================
 
 @api_router.post("/messages")
 async def send_message(message: MessageCreate, current_user: dict = Depends(get_current_user)):
     """Send a message to another user"""
-    # Check if receiver is blocked
-    receiver = await db.users.find_one({"id": message.receiver_id})
+    receiver = await db.users.find_one({"id": message.receiver_id}, {"_id": 1})
     if not receiver:
         raise HTTPException(status_code=404, detail="User not found")
     
-    if current_user["id"] in receiver.get("blocked_users", []):
+    # Either of them blocked the other
+    if await block_graph.is_hidden(current_user["id"], message.receiver_id):
         raise HTTPException(status_code=403, detail="Cannot send message to this user")
     
     message_doc = {
         "id": str(uuid.uuid4()),
+        "conversation_id": conversation_id(current_user["id"], message.receiver_id),
         "sender_id": current_user["id"],
         "receiver_id": message.receiver_id,
         "content": message.content,
@@ -497,82 +1228,213 @@ async def send_message(message: MessageCreate, current_user: dict = Depends(get_
         "created_at": datetime.now(timezone.utc).isoformat(),
         "is_read": False
     }
-    await db.messages.insert_one(message_doc)
+    await message_store.insert(message_doc)
+    await conversation_summaries.record_message(db, message_doc)
+    await view_versions.bump(db, [current_user["id"], message.receiver_id], view_versions.CONVERSATIONS)
+    
+    # Push to the receiver and to the sender's other open sessions
+    event = {"type": "message", "message": message_doc}
+    await broker.publish(user_channel(message.receiver_id), event)
+    await broker.publish(user_channel(current_user["id"]), event)
     return message_doc
 
+async def mark_conversation_read(reader_id: str, partner_id: str) -> tuple:
+    """Mark partner's messages to reader as read and push a read receipt to the partner.
+    Returns how many were marked and the read_at written."""
+    read_at = datetime.now(timezone.utc).isoformat()
+    marked = await message_store.mark_read(reader_id, partner_id, read_at)
+    if marked:
+        await conversation_summaries.mark_read(db, reader_id, partner_id, marked)
+        await view_versions.bump(db, [reader_id], view_versions.CONVERSATIONS)
+        await broker.publish(user_channel(partner_id), {
+            "type": "read",
+            "reader_id": reader_id,
+            "read_at": read_at
+        })
+    return marked, read_at
+
+async def mark_fetched_read(reader_id: str, partner_id: str, messages: list) -> None:
+    """Mark the conversation read if the fetched messages include unread ones from the partner,
+    updating them in place so the response and its sync header include the receipt"""
+    unread = [m for m in messages if m["sender_id"] == partner_id and not m["is_read"]]
+    if not unread:
+        return
+    marked, read_at = await mark_conversation_read(reader_id, partner_id)
+    if marked:
+        for message in unread:
+            message.update(is_read=True, read_at=read_at)
+
+SYNC_SINCE_HEADER = "X-Sync-Since"
+
+async def resolve_since(since: str, user_id: str, partner_id: str) -> str:
+    """`since` is an ISO timestamp or the id of the last message the client has"""
+    try:
+        datetime.fromisoformat(since)
+        return since
+    except ValueError:
+        pass
+    last = await message_store.find(conversation_id(user_id, partner_id), since)
+    if not last:
+        raise HTTPException(status_code=400, detail="Unknown message id in since")
+    return last["created_at"]
+
 @api_router.get("/messages/{user_id}")
-async def get_conversation(user_id: str, current_user: dict = Depends(get_current_user)):
-    """Get conversation with a user"""
-    messages = await db.messages.find(
-        {"$or": [
-            {"sender_id": current_user["id"], "receiver_id": user_id},
-            {"sender_id": user_id, "receiver_id": current_user["id"]}
-        ]},
-        {"_id": 0}
-    ).sort("created_at", 1).to_list(200)
+async def get_conversation(
+    user_id: str,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(200, ge=1, le=200),
+    since: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get the latest page of a conversation with a user, oldest message first.
+    The X-Next-Cursor header pages further back in time.
     
-    # Mark as read
-    await db.messages.update_many(
-        {"sender_id": user_id, "receiver_id": current_user["id"], "is_read": False},
-        {"$set": {"is_read": True}}
-    )
+    With `since` (a timestamp or the last message id the client has) only messages
+    created or read after it are returned. X-Sync-Since holds the value to pass next time."""
+    if await block_graph.is_hidden(current_user["id"], user_id):
+        raise HTTPException(status_code=403, detail="Cannot view this conversation")
+    
+    conversation = conversation_id(current_user["id"], user_id)
+    if since:
+        since = await resolve_since(since, current_user["id"], user_id)
+        messages = await message_store.changes(conversation, since)
+        await mark_fetched_read(current_user["id"], user_id, messages)
+        changed_at = [m["created_at"] for m in messages] + [m["read_at"] for m in messages if m.get("read_at")]
+        response.headers[SYNC_SINCE_HEADER] = max(changed_at, default=since)
+        return messages
+    
+    messages = await message_store.page(conversation, limit, decode_cursor(cursor) if cursor else None)
+    set_next_cursor(response, messages, limit)
+    messages.reverse()
+    
+    # Mark as read before taking the sync point, skipping the write when nothing is unread
+    await mark_fetched_read(current_user["id"], user_id, messages)
+    if messages:
+        response.headers[SYNC_SINCE_HEADER] = max(
+            [m["created_at"] for m in messages] + [m["read_at"] for m in messages if m.get("read_at")]
+        )
     
     return messages
 
+@api_router.post("/messages/{user_id}/read")
+async def mark_read(user_id: str, current_user: dict = Depends(get_current_user)):
+    """Mark a conversation as read, e.g. when a pushed message is shown"""
+    marked, _ = await mark_conversation_read(current_user["id"], user_id)
+    return {"marked_read": marked}
+
+@api_router.post("/conversations/read")
+async def mark_conversations_read(batch: MarkReadBatch, current_user: dict = Depends(get_current_user)):
+    """Mark several conversations (or all of them) as read at once"""
+    read_at = datetime.now(timezone.utc).isoformat()
+    counts = await message_store.mark_all_read(current_user["id"], batch.user_ids, read_at)
+    if not counts:
+        return {"marked_read": 0}
+    
+    await conversation_summaries.mark_read_many(db, current_user["id"], counts)
+    await view_versions.bump(db, [current_user["id"]], view_versions.CONVERSATIONS)
+    for partner_id in counts:
+        await broker.publish(user_channel(partner_id), {
+            "type": "read",
+            "reader_id": current_user["id"],
+            "read_at": read_at
+        })
+    return {"marked_read": sum(counts.values())}
+
+@api_router.websocket("/ws")
+async def realtime_events(websocket: WebSocket, token: str = ""):
+    """Push channel for chat events. Browsers cannot set headers on a WebSocket,
+    so the JWT is passed as the token query parameter."""
+    try:
+        current_user = await authenticate_token(token)
+    except HTTPException:
+        await websocket.close(code=4401)
+        return
+    
+    await websocket.accept()
+    async with broker.subscribe(user_channel(current_user["id"])) as events:
+        async def forward_events():
+            while True:
+                await websocket.send_json(await events.get())
+        
+        async def wait_for_disconnect():
+            # Client messages are ignored, receiving only detects the close
+            try:
+                while True:
+                    await websocket.receive_text()
+            except WebSocketDisconnect:
+                pass
+        
+        tasks = [asyncio.create_task(forward_events()), asyncio.create_task(wait_for_disconnect())]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            if not task.cancelled() and task.exception() and not isinstance(task.exception(), WebSocketDisconnect):
+                logger.error(f"Realtime connection error: {task.exception()}")
+
 @api_router.get("/conversations")
-async def get_conversations(current_user: dict = Depends(get_current_user)):
+async def get_conversations(
+    request: Request,
+    response: Response,
+    current_user: dict = Depends(get_current_user),
+    users: UserLoader = Depends(get_user_loader)
+):
     """Get all conversations"""
-    # Get all unique conversation partners
-    pipeline = [
-        {"$match": {"$or": [{"sender_id": current_user["id"]}, {"receiver_id": current_user["id"]}]}},
-        {"$sort": {"created_at": -1}},
-        {"$group": {
-            "_id": {"$cond": [{"$eq": ["$sender_id", current_user["id"]]}, "$receiver_id", "$sender_id"]},
-            "last_message": {"$first": "$$ROOT"},
-            "unread_count": {"$sum": {"$cond": [{"$and": [{"$eq": ["$receiver_id", current_user["id"]]}, {"$eq": ["$is_read", False]}]}, 1, 0]}}
-        }}
-    ]
+    versions = await view_versions.get(db, current_user["id"])
+    blocks_version = versions["user"].get(view_versions.BLOCKS, 0)
+    cached = not_modified(request, response, view_versions.etag(
+        "conversations", current_user["id"], versions["user"].get(view_versions.CONVERSATIONS, 0), blocks_version
+    ))
+    if cached:
+        return cached
     
-    results = await db.messages.aggregate(pipeline).to_list(50)
+    hidden = await block_graph.hidden_ids(current_user["id"], blocks_version)
+    summaries = await conversation_summaries.list_for_user(db, current_user["id"], exclude=hidden)
     
+    partners = await users.load_many([summary["partner_id"] for summary in summaries])
     conversations = []
-    for r in results:
-        partner_id = r["_id"]
-        partner = await db.users.find_one({"id": partner_id}, {"_id": 0, "password_hash": 0, "blocked_users": 0})
+    for summary in summaries:
+        partner = partners.get(summary["partner_id"])
         if partner:
             conversations.append({
-                "partner": {
-                    "id": partner["id"],
-                    "nickname": partner.get("display_name", partner["nickname"]),
-                    "avatar_url": partner["avatar_url"]
-                },
+                "partner": public_profile(partner),
                 "last_message": {
-                    "content": r["last_message"]["content"],
-                    "created_at": r["last_message"]["created_at"],
-                    "is_mine": r["last_message"]["sender_id"] == current_user["id"]
+                    "content": summary["last_message"]["content"],
+                    "created_at": summary["last_message"]["created_at"],
+                    "is_mine": summary["last_message"]["sender_id"] == current_user["id"]
                 },
-                "unread_count": r["unread_count"]
+                "unread_count": max(summary["unread_count"], 0)
             })
     
     return conversations
 
+@api_router.get("/conversations/unread")
+async def get_unread_count(current_user: dict = Depends(get_current_user)):
+    """Total unread messages, for the chat badge"""
+    hidden = await block_graph.hidden_ids(current_user["id"])
+    return {"unread_count": await conversation_summaries.unread_total(db, current_user["id"], exclude=hidden)}
+
 # ==================== SAFETY ROUTES ====================
 
 @api_router.post("/block")
 async def block_user(block: BlockUser, current_user: dict = Depends(get_current_user)):
     """Block a user"""
-    await db.users.update_one(
-        {"id": current_user["id"]},
-        {"$addToSet": {"blocked_users": block.blocked_user_id}}
+    await block_graph.block(current_user["id"], block.blocked_user_id)
+    # Both users disappear from each other's feed, suggestions, friends and chats
+    await view_versions.bump(
+        db, [current_user["id"], block.blocked_user_id],
+        view_versions.FEED, view_versions.SUGGESTIONS, view_versions.FRIENDS, view_versions.CONVERSATIONS
     )
     return {"message": "User blocked"}
 
 @api_router.post("/unblock/{user_id}")
 async def unblock_user(user_id: str, current_user: dict = Depends(get_current_user)):
     """Unblock a user"""
-    await db.users.update_one(
-        {"id": current_user["id"]},
-        {"$pull": {"blocked_users": user_id}}
+    await block_graph.unblock(current_user["id"], user_id)
+    await view_versions.bump(
+        db, [current_user["id"], user_id],
+        view_versions.FEED, view_versions.SUGGESTIONS, view_versions.FRIENDS, view_versions.CONVERSATIONS
     )
     return {"message": "User unblocked"}
 
@@ -599,6 +1461,31 @@ async def get_reports(current_user: dict = Depends(get_current_user)):
     reports = await db.reports.find({"status": "pending"}, {"_id": 0}).to_list(100)
     return reports
 
+@api_router.get("/admin/moderation-queue")
+async def get_moderation_queue_stats(current_user: dict = Depends(get_current_user)):
+    """Moderation jobs by status"""
+    return await moderation_queue.counts()
+
+@api_router.get("/admin/principal-cache")
+async def get_principal_cache_stats(current_user: dict = Depends(get_current_user)):
+    """Hit/miss counters of the authenticated-principal cache in this process"""
+    return principal_cache.get_stats()
+
+@api_router.get("/admin/password-hashing")
+async def get_password_hashing_stats(current_user: dict = Depends(get_current_user)):
+    """Queue wait and run times of password hashing in this process"""
+    return password_hasher.get_stats()
+
+@api_router.get("/admin/moderation-client")
+async def get_moderation_client_stats(current_user: dict = Depends(get_current_user)):
+    """Image analysis circuit breaker state and call counters for this process"""
+    return moderation_client.get_stats()
+
+@api_router.get("/admin/moderation-cache")
+async def get_moderation_cache_stats(current_user: dict = Depends(get_current_user)):
+    """Moderation cache hit/miss counters for this process"""
+    return moderation_cache.get_stats()
+
 @api_router.post("/admin/reports/{report_id}/resolve")
 async def resolve_report(report_id: str, action: str = "dismissed", current_user: dict = Depends(get_current_user)):
     """Resolve a report"""
@@ -636,6 +1523,23 @@ async def get_avatars():
 async def root():
     return {"message": "FriendSnap API is running!"}
 
+# ==================== METRICS ====================
+
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+metrics.stats_gauge("friendsnap_password_hashing", "Password hashing pool counters", password_hasher.get_stats)
+metrics.stats_gauge("friendsnap_principal_cache", "Authenticated principal cache counters", principal_cache.get_stats)
+metrics.stats_gauge("friendsnap_block_cache", "Cached block sets counters", block_graph.get_stats)
+metrics.stats_gauge("friendsnap_moderation_client", "Image analysis client and circuit breaker", moderation_client.get_stats)
+metrics.stats_gauge("friendsnap_moderation_cache", "Moderation result cache counters", moderation_cache.get_stats)
+
+@api_router.get("/metrics")
+async def get_metrics(request: Request):
+    """Prometheus metrics. Set METRICS_TOKEN to require it as a bearer token."""
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Not authorized")
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 @api_router.get("/health")
 async def health():
     return {"status": "healthy"}
@@ -649,8 +1553,108 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, SYNC_SINCE_HEADER],
 )
+app.middleware("http")(metrics.track_request)
+
+@app.on_event("startup")
+async def create_indexes():
+    # Every index the queries need, see db_indexes.INDEXES
+    await apply_indexes(db)
+
+@app.on_event("startup")
+async def start_event_loop_monitor():
+    app.state.loop_monitor = asyncio.create_task(metrics.monitor_event_loop())
+
+@app.on_event("startup")
+async def start_moderation_queue():
+    moderation_queue.start()
+
+@app.on_event("startup")
+async def migrate_messages():
+    # Awaited rather than run in the background: chats are read by conversation_id,
+    # so older messages without one would be missing until it finishes
+    migrated = await message_store.migrate()
+    if migrated:
+        logger.info(f"Migrated {migrated} messages to conversation storage")
+
+@app.on_event("startup")
+async def build_conversation_summaries():
+    if await db[conversation_summaries.COLLECTION].estimated_document_count() == 0:
+        written = await conversation_summaries.rebuild(db, message_store.iter_all())
+        if written:
+            logger.info(f"Conversation summaries rebuilt: {written}")
+
+@app.on_event("startup")
+async def build_blocks():
+    # Backfill once from the blocked_users arrays used before the block store existed
+    if await db[blocks.COLLECTION].estimated_document_count() == 0:
+        written = await block_graph.rebuild()
+        if written:
+            logger.info(f"Blocks rebuilt with {written} edges")
+
+@app.on_event("startup")
+async def build_friendships():
+    # Backfill once from requests accepted before the adjacency store existed
+    if await db[friendships.COLLECTION].estimated_document_count() == 0:
+        written = await friendships.rebuild(db)
+        if written:
+            logger.info(f"Friendships rebuilt with {written} edges")
+
+@app.on_event("startup")
+async def build_interest_index():
+    # Backfill once for databases created before the index existed
+    if await db[interest_index.COLLECTION].estimated_document_count() == 0:
+        written = await interest_index.rebuild(db)
+        logger.info(f"Interest index rebuilt with {written} postings")
+    elif await db[interest_index.STATS_COLLECTION].estimated_document_count() == 0:
+        written = await interest_index.rebuild_term_stats(db)
+        logger.info(f"Interest term frequencies rebuilt for {written} terms")
+
+@app.on_event("startup")
+async def build_blob_refs():
+    # Backfill once for databases created before blobs were reference counted,
+    # before the image migration starts adding references
+    if await shared_blobs.refs.estimated_document_count() == 0:
+        written = await shared_blobs.rebuild()
+        if written:
+            logger.info(f"Blob references counted for {written} blobs")
+
+async def migrate_photo_images():
+    """Move inline image_base64 into the blob store and create missing variants"""
+    migrated = 0
+    async for photo in db.photos.find(
+        {"image_layout": {"$exists": False}},
+        {"_id": 0, "id": 1, "image_base64": 1, "image_key": 1, "image_variants": 1}
+    ):
+        if "image_variants" in photo:
+            # Stored before the marker existed, nothing to move
+            await db.photos.update_one({"id": photo["id"]}, {"$set": {"image_layout": IMAGE_LAYOUT}})
+            continue
+        try:
+            if photo.get("image_key"):
+                data = await blob_store.read(photo["image_key"])
+            else:
+                data = base64.b64decode(photo["image_base64"])
+            image_fields = await store_image(data)
+        except Exception as e:
+            logger.error(f"Could not migrate image of photo {photo['id']}: {e}")
+            continue
+        await db.photos.update_one(
+            {"id": photo["id"]},
+            {"$set": image_fields, "$unset": {"image_base64": ""}}
+        )
+        migrated += 1
+    if migrated:
+        logger.info(f"Migrated images of {migrated} photos")
+
+@app.on_event("startup")
+async def start_image_migration():
+    asyncio.create_task(migrate_photo_images())
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    app.state.loop_monitor.cancel()
+    await moderation_queue.stop()
+    password_hasher.shutdown()
     client.close()
@@ -0,0 +1,164 @@
+"""Batch friend suggestions.
+
+Builds a sparse user x term matrix from the interest index (tags and
+categories of approved photos) and scores every pair of users in one sparse
+matrix product, keeping the top ``TOP_K`` per user:
+
+    {"user_id", "computed_at", "suggestions": [{"user_id", "score", "shared_tags", "shared_categories"}]}
+
+Scores use the same weights as live scoring (2 per shared tag, 3 per shared
+category). With TF-IDF each term is also weighted by its inverse user
+frequency, so ubiquitous tags barely count.
+
+Run it from cron:
+
+    python similarity.py [--tfidf]
+"""
+import asyncio
+import logging
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import List, Optional
+
+from pymongo import IndexModel, ReplaceOne
+
+import interest_index
+import view_versions
+
+logger = logging.getLogger(__name__)
+
+COLLECTION = "precomputed_suggestions"
+
+INDEXES = [
+    IndexModel("user_id", unique=True),
+]
+
+# Stored per user. More than the page shown, so friends and blocked users
+# can be filtered out when serving.
+TOP_K = 50
+TAG_WEIGHT = 2
+CATEGORY_WEIGHT = 3
+# Users scored per sparse product, bounds the memory of one block
+BLOCK_SIZE = 1000
+# TF-IDF weight factor of a term every user has: barely counts, but still
+# ranks users sharing only common terms above unrelated ones
+MIN_IDF = 0.05
+
+
+def score_users(postings: List[dict], top_k: int = TOP_K, tfidf: bool = False) -> dict:
+    """``{user_id: [(other_user_id, score), ...]}`` best first, from ``{"user_id", "term"}`` postings"""
+    import numpy as np
+    from scipy import sparse
+
+    users = sorted({p["user_id"] for p in postings})
+    terms = sorted({p["term"] for p in postings})
+    if len(users) < 2:
+        return {}
+    user_index = {uid: i for i, uid in enumerate(users)}
+    term_index = {term: i for i, term in enumerate(terms)}
+
+    rows = np.fromiter((user_index[p["user_id"]] for p in postings), dtype=np.int32, count=len(postings))
+    cols = np.fromiter((term_index[p["term"]] for p in postings), dtype=np.int32, count=len(postings))
+    present = sparse.csr_matrix((np.ones(len(postings), dtype=np.float32), (rows, cols)), shape=(len(users), len(terms)))
+    present.data[:] = 1  # duplicate postings must not count twice
+
+    weights = np.array(
+        [TAG_WEIGHT if term.startswith(interest_index.TAG_PREFIX) else CATEGORY_WEIGHT for term in terms],
+        dtype=np.float32
+    )
+    if tfidf:
+        users_per_term = np.asarray(present.sum(axis=0)).ravel()
+        idf = np.log((1 + len(users)) / (1 + users_per_term))
+        weights *= np.maximum(idf, MIN_IDF).astype(np.float32)
+    weighted = present @ sparse.diags(weights)
+    present_t = present.T.tocsr()
+
+    ranked = {}
+    for start in range(0, len(users), BLOCK_SIZE):
+        block = (weighted[start:start + BLOCK_SIZE] @ present_t).tocsr()
+        for offset in range(block.shape[0]):
+            i = start + offset
+            row = block.getrow(offset)
+            others, scores = row.indices, row.data
+            keep = others != i
+            others, scores = others[keep], scores[keep]
+            if not len(others):
+                continue
+            if len(others) > top_k:
+                best = np.argpartition(-scores, top_k)[:top_k]
+                others, scores = others[best], scores[best]
+            order = np.argsort(-scores, kind="stable")
+            ranked[users[i]] = [(users[others[j]], round(float(scores[j]), 2)) for j in order]
+    return ranked
+
+
+def _shared(mine: set, theirs: set, prefix: str) -> List[str]:
+    return sorted(term[len(prefix):] for term in mine & theirs if term.startswith(prefix))
+
+
+async def rebuild(db, tfidf: bool = False) -> int:
+    """Recompute and store everyone's suggestions. Returns users written."""
+    postings = await db[interest_index.COLLECTION].find(
+        {"count": {"$gt": 0}}, {"_id": 0, "user_id": 1, "term": 1}
+    ).to_list(None)
+    ranked = await asyncio.to_thread(score_users, postings, TOP_K, tfidf)
+
+    terms_by_user = {}
+    for posting in postings:
+        terms_by_user.setdefault(posting["user_id"], set()).add(posting["term"])
+
+    computed_at = datetime.now(timezone.utc).isoformat()
+    ops = []
+    for user_id, others in ranked.items():
+        mine = terms_by_user[user_id]
+        ops.append(ReplaceOne({"user_id": user_id}, {
+            "user_id": user_id,
+            "computed_at": computed_at,
+            "suggestions": [{
+                "user_id": other_id,
+                "score": score,
+                "shared_tags": _shared(mine, terms_by_user[other_id], interest_index.TAG_PREFIX),
+                "shared_categories": _shared(mine, terms_by_user[other_id], interest_index.CATEGORY_PREFIX),
+            } for other_id, score in others]
+        }, upsert=True))
+        if len(ops) >= 1000:
+            await db[COLLECTION].bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        await db[COLLECTION].bulk_write(ops, ordered=False)
+    # Users without any match anymore get live scoring again
+    await db[COLLECTION].delete_many({"computed_at": {"$ne": computed_at}})
+    await view_versions.bump(db, [view_versions.GLOBAL], view_versions.SUGGESTIONS)
+    return len(ranked)
+
+
+async def get_suggestions(db, user_id: str) -> Optional[List[dict]]:
+    """Stored suggestions best first, None when the user wasn't scored in the last run"""
+    doc = await db[COLLECTION].find_one({"user_id": user_id}, {"_id": 0, "suggestions": 1})
+    return doc["suggestions"] if doc else None
+
+
+async def _main(tfidf: bool) -> int:
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ.get('DB_NAME', 'friendsnap')]
+    try:
+        written = await rebuild(db, tfidf=tfidf)
+        logger.info(f"Suggestions computed for {written} users")
+        return 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args not in ([], ["--tfidf"]):
+        print("usage: python similarity.py [--tfidf]")
+        sys.exit(2)
+    sys.exit(asyncio.run(_main(tfidf=bool(args))))
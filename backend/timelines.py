@@ -0,0 +1,87 @@
+"""Per-user home timelines, filled on write.
+
+One document per user holds their newest feed entries, newest first:
+
+    {"user_id", "entries": [{"id": photo_id, "user_id": owner_id, "created_at"}, ...]}
+
+When a photo is approved its entry is pushed to every recipient with a
+single ``$push``/``$sort``/``$slice``, which also trims the timeline to
+``MAX_ENTRIES``. Reading a feed page is one document fetch.
+"""
+from typing import Iterable, List, Optional, Tuple
+
+from pymongo import IndexModel, UpdateOne
+
+COLLECTION = "timelines"
+
+# Entries kept per user; older photos fall off the end of the timeline
+MAX_ENTRIES = 500
+# Users with fewer entries than this (new users, few friends or interests)
+# read the global feed instead
+MIN_ENTRIES = 20
+# Upper bound on timelines one photo is pushed to
+MAX_FANOUT = 2000
+# Interest-matched users a photo is pushed to besides friends, best matches first
+MAX_INTEREST_RECIPIENTS = 200
+
+INDEXES = [
+    IndexModel("user_id", unique=True),
+    # Removing a deleted photo from every timeline
+    IndexModel("entries.id"),
+]
+
+
+def _entry(photo: dict) -> dict:
+    return {"id": photo["id"], "user_id": photo["user_id"], "created_at": photo["created_at"]}
+
+
+async def push(db, photo: dict, recipient_ids: Iterable[str]) -> List[str]:
+    """Add a photo to the recipients' timelines. Returns the users whose timeline was written."""
+    entry = _entry(photo)
+    recipients = list(dict.fromkeys(recipient_ids))[:MAX_FANOUT]
+    ops = [
+        UpdateOne(
+            {"user_id": uid},
+            {"$push": {"entries": {
+                "$each": [entry],
+                "$sort": {"created_at": -1, "id": -1},
+                "$slice": MAX_ENTRIES
+            }}},
+            upsert=True
+        )
+        for uid in recipients
+    ]
+    if ops:
+        # Pushing twice (e.g. a retried job) is harmless apart from a duplicate entry,
+        # which read_page drops
+        await db[COLLECTION].bulk_write(ops, ordered=False)
+    return recipients
+
+
+async def remove_photo(db, photo_id: str) -> List[str]:
+    """Pull a deleted photo from every timeline. Returns the users whose timeline had it."""
+    holders = await db[COLLECTION].find({"entries.id": photo_id}, {"_id": 0, "user_id": 1}).to_list(None)
+    if holders:
+        await db[COLLECTION].update_many({"entries.id": photo_id}, {"$pull": {"entries": {"id": photo_id}}})
+    return [holder["user_id"] for holder in holders]
+
+
+async def read_page(
+    db, user_id: str, limit: int, before: Optional[Tuple[str, str]] = None, exclude_owners: Iterable[str] = ()
+) -> Optional[List[dict]]:
+    """Up to ``limit`` entries older than ``before`` (created_at, id), None when the timeline is too short to use"""
+    doc = await db[COLLECTION].find_one({"user_id": user_id}, {"_id": 0, "entries": 1})
+    if not doc or len(doc.get("entries", [])) < MIN_ENTRIES:
+        return None
+    excluded = set(exclude_owners)
+    page, seen = [], set()
+    for entry in doc["entries"]:
+        if before and (entry["created_at"], entry["id"]) >= before:
+            continue
+        if entry["user_id"] in excluded or entry["id"] in seen:
+            continue
+        seen.add(entry["id"])
+        page.append(entry)
+        if len(page) == limit:
+            break
+    return page
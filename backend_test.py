@@ -1,15 +1,20 @@
 import requests
 import sys
+import os
 import json
 import base64
 from datetime import datetime
 import time
+from websockets.sync.client import connect
 
 class FriendSnapAPITester:
     def __init__(self, base_url="https://share-memories-1.preview.emergentagent.com/api"):
         self.base_url = base_url
         self.token = None
         self.user_id = None
+        self.friend_token = None
+        self.friend_id = None
+        self.message_id = None
         self.tests_run = 0
         self.tests_passed = 0
         self.test_results = []
@@ -29,12 +34,13 @@ class FriendSnapAPITester:
             "details": details
         })
 
-    def run_test(self, name, method, endpoint, expected_status, data=None, files=None):
-        """Run a single API test"""
+    def run_test(self, name, method, endpoint, expected_status, data=None, files=None, token=None):
+        """Run a single API test, as the given user's token if set"""
         url = f"{self.base_url}/{endpoint}"
         headers = {'Content-Type': 'application/json'}
-        if self.token:
-            headers['Authorization'] = f'Bearer {self.token}'
+        token = token or self.token
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
 
         print(f"\n🔍 Testing {name}...")
         print(f"   URL: {url}")
@@ -82,6 +88,12 @@ class FriendSnapAPITester:
         self.run_test("Root endpoint", "GET", "", 200)
         self.run_test("Health endpoint", "GET", "health", 200)
 
+    def test_metrics(self):
+        """Test the Prometheus metrics endpoint"""
+        print("\n=== METRICS TESTS ===")
+        # Deployments that set METRICS_TOKEN need it passed the same way
+        self.run_test("Get metrics", "GET", "metrics", 200, token=os.environ.get('METRICS_TOKEN'))
+
     def test_avatars(self):
         """Test avatar endpoint"""
         print("\n=== AVATAR TESTS ===")
@@ -163,6 +175,15 @@ class FriendSnapAPITester:
             photo_id = response['id']
             print(f"   Uploaded photo ID: {photo_id}")
         
+        # Test get moderation status
+        if photo_id:
+            self.run_test("Get photo status", "GET", f"photos/{photo_id}/status", 200)
+        
+        # Test get photo image, through the signed URL while it is still pending
+        if photo_id:
+            image_endpoint = response['full_image_url'].split('/api/', 1)[1]
+            self.run_test("Get photo image", "GET", image_endpoint, 200)
+        
         # Test get my photos
         self.run_test("Get my photos", "GET", "photos/mine", 200)
         
@@ -198,8 +219,221 @@ class FriendSnapAPITester:
         # Test get conversations
         self.run_test("Get conversations", "GET", "conversations", 200)
         
-        # Note: We can't easily test sending messages without another user
-        # This would require creating a second user account
+        # A second user account to chat with
+        success, response = self.run_test(
+            "Second user registration",
+            "POST",
+            "auth/register",
+            200,
+            data={
+                "nickname": f"testfriend_{int(time.time())}",
+                "avatar_url": "https://api.dicebear.com/7.x/bottts/svg?seed=friend",
+                "password": "testpass123"
+            }
+        )
+        if not (success and 'token' in response):
+            return
+        self.friend_token = response['token']
+        self.friend_id = response['user']['id']
+        
+        # Test send message
+        success, response = self.run_test(
+            "Send message",
+            "POST",
+            "messages",
+            200,
+            data={"receiver_id": self.friend_id, "content": "Hello from the API tests"}
+        )
+        if success and 'id' in response:
+            self.message_id = response['id']
+        
+        # Test get messages
+        self.run_test("Get messages", "GET", f"messages/{self.friend_id}", 200)
+
+    def test_realtime(self):
+        """Test chat events pushed over the WebSocket"""
+        print("\n=== REALTIME TESTS ===")
+        if not self.friend_token:
+            print("   Skipped: no second user")
+            return
+        
+        ws_url = self.base_url.replace("http", "ws", 1) + f"/ws?token={self.friend_token}"
+        print("\n🔍 Testing Receive pushed message...")
+        print(f"   URL: {ws_url.split('?')[0]}")
+        try:
+            with connect(ws_url, open_timeout=10) as websocket:
+                self.run_test(
+                    "Send message to connected user",
+                    "POST",
+                    "messages",
+                    200,
+                    data={"receiver_id": self.friend_id, "content": "Pushed hello"}
+                )
+                event = json.loads(websocket.recv(timeout=10))
+                success = event.get('type') == 'message' and event.get('message', {}).get('content') == "Pushed hello"
+                self.log_result("Receive pushed message", success, f"Unexpected event: {event}")
+        except Exception as e:
+            self.log_result("Receive pushed message", False, f"Exception: {str(e)}")
+        
+        # Test mark conversation read
+        self.run_test(
+            "Mark conversation read",
+            "POST",
+            f"messages/{self.user_id}/read",
+            200,
+            token=self.friend_token
+        )
+
+    def test_chat_sync(self):
+        """Test fetching only what changed in a conversation"""
+        print("\n=== CHAT SYNC TESTS ===")
+        if not self.message_id:
+            print("   Skipped: no message sent")
+            return
+        
+        # Test messages since the last one the client has
+        success, response = self.run_test(
+            "Get messages since message id",
+            "GET",
+            f"messages/{self.friend_id}?since={self.message_id}",
+            200
+        )
+        if success:
+            print(f"   {len(response)} changed messages")
+        
+        # Test messages since a timestamp
+        self.run_test(
+            "Get messages since timestamp",
+            "GET",
+            f"messages/{self.friend_id}?since=2020-01-01T00:00:00%2B00:00",
+            200
+        )
+        
+        # Test unknown message id
+        self.run_test(
+            "Get messages since unknown id",
+            "GET",
+            f"messages/{self.friend_id}?since=unknown-message-id",
+            400
+        )
+
+    def test_unread_counts(self):
+        """Test the unread counters kept per conversation"""
+        print("\n=== UNREAD TESTS ===")
+        if not self.friend_token:
+            print("   Skipped: no second user")
+            return
+        
+        # A reply from the second user leaves one unread message
+        self.run_test(
+            "Reply from second user",
+            "POST",
+            "messages",
+            200,
+            data={"receiver_id": self.user_id, "content": "Hello back"},
+            token=self.friend_token
+        )
+        
+        # Test unread total
+        success, response = self.run_test("Get unread count", "GET", "conversations/unread", 200)
+        if success:
+            self.log_result(
+                "Unread count includes reply",
+                response.get('unread_count', 0) >= 1,
+                f"Got {response}"
+            )
+        
+        # Test unread count per conversation
+        success, response = self.run_test("Get conversations with unread", "GET", "conversations", 200)
+        if success:
+            unread = [c['unread_count'] for c in response if c['partner']['id'] == self.friend_id]
+            self.log_result(
+                "Conversation unread count",
+                unread == [1],
+                f"Expected [1], got {unread}"
+            )
+
+    def test_batch_endpoints(self):
+        """Test batch upload, batch accept and bulk mark-read"""
+        print("\n=== BATCH TESTS ===")
+        test_image_base64 = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+        
+        # Test batch upload as JSON, one photo fails on its own
+        success, response = self.run_test(
+            "Batch upload photos",
+            "POST",
+            "photos/batch",
+            200,
+            data={"photos": [
+                {"image_base64": test_image_base64, "category": "art"},
+                {"image_base64": "not-an-image", "category": "art"}
+            ]}
+        )
+        uploaded = []
+        if success:
+            uploaded = [item['photo']['id'] for item in response if 'photo' in item]
+            self.log_result(
+                "Batch upload per-photo results",
+                len(uploaded) == 1 and 'error' in response[1],
+                f"Got {response}"
+            )
+        
+        # Test batch upload as multipart files
+        success, response = self.run_test(
+            "Batch upload photo files",
+            "POST",
+            "photos/batch",
+            200,
+            files=[
+                ('file', ('dot1.png', base64.b64decode(test_image_base64), 'image/png')),
+                ('file', ('dot2.png', base64.b64decode(test_image_base64), 'image/png')),
+                ('category', (None, 'art'))
+            ]
+        )
+        if success:
+            uploaded += [item['photo']['id'] for item in response if 'photo' in item]
+        
+        for photo_id in uploaded:
+            self.run_test("Delete batch photo", "DELETE", f"photos/{photo_id}", 200)
+        
+        if not self.friend_token:
+            print("   Skipped friend and chat batches: no second user")
+            return
+        
+        # Test batch accept, with a request id that does not exist
+        self.run_test(
+            "Friend request from second user",
+            "POST",
+            f"friends/request/{self.user_id}",
+            200,
+            token=self.friend_token
+        )
+        success, response = self.run_test("Get incoming friend requests", "GET", "friends/requests", 200)
+        request_ids = [req['id'] for req in response if req['sender_id'] == self.friend_id] if success else []
+        if request_ids:
+            success, response = self.run_test(
+                "Accept friend requests",
+                "POST",
+                "friends/accept",
+                200,
+                data={"request_ids": request_ids + ["unknown-request-id"]}
+            )
+            if success:
+                self.log_result(
+                    "Accepted and not found requests",
+                    response.get('accepted') == request_ids and response.get('not_found') == ["unknown-request-id"],
+                    f"Got {response}"
+                )
+        
+        # Test mark every conversation read
+        self.run_test("Mark all conversations read", "POST", "conversations/read", 200, data={})
+        success, response = self.run_test("Get unread count after read", "GET", "conversations/unread", 200)
+        if success:
+            self.log_result(
+                "No unread messages left",
+                response.get('unread_count') == 0,
+                f"Got {response}"
+            )
 
     def test_safety(self):
         """Test safety endpoints"""
@@ -241,9 +475,24 @@ class FriendSnapAPITester:
         # Chat tests
         self.test_chat()
         
+        # Realtime tests
+        self.test_realtime()
+        
+        # Chat sync tests
+        self.test_chat_sync()
+        
+        # Unread tests
+        self.test_unread_counts()
+        
+        # Batch tests
+        self.test_batch_endpoints()
+        
         # Safety tests
         self.test_safety()
         
+        # Metrics tests, after the others have recorded some traffic
+        self.test_metrics()
+        
         # Print summary
         print(f"\n📊 TEST SUMMARY")
         print(f"Tests run: {self.tests_run}")
@@ -22,7 +22,7 @@ export default function AddPhotoPage() {
   const navigate = useNavigate();
   const fileInputRef = useRef(null);
   const [selectedImage, setSelectedImage] = useState(null);
-  const [imageBase64, setImageBase64] = useState(null);
+  const [selectedFile, setSelectedFile] = useState(null);
   const [description, setDescription] = useState('');
   const [uploading, setUploading] = useState(false);
   const [dragOver, setDragOver] = useState(false);
@@ -41,13 +41,9 @@ export default function AddPhotoPage() {
     }
 
     const reader = new FileReader();
-    reader.onload = (e) => {
-      setSelectedImage(e.target.result);
-      // Remove data URL prefix for base64
-      const base64 = e.target.result.split(',')[1];
-      setImageBase64(base64);
-    };
+    reader.onload = (e) => setSelectedImage(e.target.result);
     reader.readAsDataURL(file);
+    setSelectedFile(file);
   };
 
   const handleDrop = (e) => {
@@ -58,19 +54,34 @@ export default function AddPhotoPage() {
   };
 
   const handleUpload = async () => {
-    if (!imageBase64) {
+    if (!selectedFile) {
       toast.error('Please choose a photo first!');
       return;
     }
 
     setUploading(true);
     try {
-      const response = await axios.post(`${API}/photos`, {
-        image_base64: imageBase64,
-        description: description
-      });
-
-      toast.success('Photo shared!');
+      // Sent as a file upload, not base64 in JSON
+      const form = new FormData();
+      form.append('file', selectedFile);
+      form.append('description', description);
+      const response = await axios.post(`${API}/photos`, form);
+
+      // New photos are checked in the background, wait for the result
+      let status = response.data.status;
+      let detail = null;
+      for (let i = 0; status === 'pending' && i < 30; i++) {
+        await new Promise((resolve) => setTimeout(resolve, 2000));
+        const statusRes = await axios.get(`${API}/photos/${response.data.id}/status`);
+        status = statusRes.data.status;
+        detail = statusRes.data.detail;
+      }
+
+      if (status === 'rejected') {
+        toast.error(detail || 'This photo could not be shared. Try another one!');
+        return;
+      }
+      toast.success(status === 'pending' ? 'Photo is being checked. It will show up soon!' : 'Photo shared!');
       navigate('/my-photos');
     } catch (error) {
       const message = error.response?.data?.detail || 'Could not upload photo. Try again!';
@@ -82,7 +93,7 @@ export default function AddPhotoPage() {
 
   const clearImage = () => {
     setSelectedImage(null);
-    setImageBase64(null);
+    setSelectedFile(null);
     setDescription('');
   };
 
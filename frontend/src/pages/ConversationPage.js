@@ -31,7 +31,7 @@ const COMMON_EMOJIS = ["😊", "👍", "❤️", "🎉", "⭐", "🌟", "🎵",
 export default function ConversationPage() {
   const { userId } = useParams();
   const navigate = useNavigate();
-  const { user } = useAuth();
+  const { user, token } = useAuth();
   const [partner, setPartner] = useState(null);
   const [messages, setMessages] = useState([]);
   const [newMessage, setNewMessage] = useState('');
@@ -39,21 +39,97 @@ export default function ConversationPage() {
   const [sending, setSending] = useState(false);
   const [showEmojis, setShowEmojis] = useState(false);
   const messagesEndRef = useRef(null);
+  const syncSinceRef = useRef(null);
 
   useEffect(() => {
     fetchMessages();
-    const interval = setInterval(fetchMessages, 5000); // Poll every 5 seconds
-    return () => clearInterval(interval);
-  }, [userId]);
+
+    // New messages and read receipts are pushed over a WebSocket.
+    // Poll every 5 seconds only while the socket is not connected.
+    let socket = null;
+    let interval = null;
+    let closed = false;
+
+    const startPolling = () => {
+      if (!interval) interval = setInterval(pollMessages, 5000);
+    };
+    const stopPolling = () => {
+      clearInterval(interval);
+      interval = null;
+    };
+
+    const connect = () => {
+      const wsUrl = `${API.replace(/^http/, 'ws')}/ws?token=${encodeURIComponent(token)}`;
+      socket = new WebSocket(wsUrl);
+      socket.onopen = () => {
+        stopPolling();
+        pollMessages(); // catch up on anything sent while disconnected
+      };
+      socket.onmessage = (e) => {
+        const event = JSON.parse(e.data);
+        if (event.type === 'message') {
+          const msg = event.message;
+          const inThisChat = msg.sender_id === userId || msg.receiver_id === userId;
+          if (!inThisChat) return;
+          setMessages((prev) => (prev.some((m) => m.id === msg.id) ? prev : [...prev, msg]));
+          if (msg.sender_id === userId) {
+            axios.post(`${API}/messages/${userId}/read`).catch(() => {});
+          }
+        } else if (event.type === 'read' && event.reader_id === userId) {
+          setMessages((prev) => prev.map((m) => (m.receiver_id === userId ? { ...m, is_read: true } : m)));
+        }
+      };
+      socket.onclose = () => {
+        if (closed) return;
+        startPolling();
+        setTimeout(() => !closed && connect(), 10000);
+      };
+    };
+
+    if (token) {
+      connect();
+    } else {
+      startPolling();
+    }
+
+    return () => {
+      closed = true;
+      stopPolling();
+      if (socket) socket.close();
+    };
+  }, [userId, token]);
 
   useEffect(() => {
     scrollToBottom();
   }, [messages]);
 
+  const mergeMessages = (changed) => {
+    setMessages((prev) => {
+      const byId = new Map(prev.map((m) => [m.id, m]));
+      changed.forEach((m) => byId.set(m.id, m));
+      return [...byId.values()].sort((a, b) => a.created_at.localeCompare(b.created_at));
+    });
+  };
+
+  // Only asks for messages created or read since the last sync
+  const pollMessages = async () => {
+    if (!syncSinceRef.current) return fetchMessages();
+    try {
+      const response = await axios.get(`${API}/messages/${userId}`, {
+        params: { since: syncSinceRef.current }
+      });
+      syncSinceRef.current = response.headers['x-sync-since'] || syncSinceRef.current;
+      if (response.data.length > 0) mergeMessages(response.data);
+    } catch (error) {
+      console.error('Failed to fetch messages:', error);
+    }
+  };
+
   const fetchMessages = async () => {
     try {
       const response = await axios.get(`${API}/messages/${userId}`);
       setMessages(response.data);
+      syncSinceRef.current = response.headers['x-sync-since'] || null;
       
       // Get partner info from first message or suggestions
       if (response.data.length > 0) {
@@ -97,7 +173,7 @@ export default function ConversationPage() {
         content: content,
         message_type: type
       });
-      setMessages([...messages, response.data]);
+      setMessages((prev) => (prev.some((m) => m.id === response.data.id) ? prev : [...prev, response.data]));
       setNewMessage('');
       setShowEmojis(false);
     } catch (error) {
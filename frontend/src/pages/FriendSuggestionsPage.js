@@ -150,10 +150,10 @@ export default function FriendSuggestionsPage() {
                         </div>
                       )}
 
-                      {suggestion.sample_photo && (
+                      {suggestion.sample_photo_url && (
                         <div className="w-24 h-24 rounded-xl overflow-hidden mb-3">
                           <img
-                            src={`data:image/jpeg;base64,${suggestion.sample_photo}`}
+                            src={`${process.env.REACT_APP_BACKEND_URL}${suggestion.sample_photo_url}`}
                             alt="Sample photo"
                             className="w-full h-full object-cover"
                           />
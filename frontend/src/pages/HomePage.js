@@ -163,7 +163,7 @@ export default function HomePage() {
                   data-testid={`photo-${index}`}
                 >
                   <img
-                    src={`data:image/jpeg;base64,${photo.image_base64}`}
+                    src={`${process.env.REACT_APP_BACKEND_URL}${photo.image_url}`}
                     alt={photo.description || photo.category}
                   />
                   <div className="photo-card-overlay">
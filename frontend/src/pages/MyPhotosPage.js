@@ -127,7 +127,7 @@ export default function MyPhotosPage() {
                 data-testid={`my-photo-${index}`}
               >
                 <img
-                  src={`data:image/jpeg;base64,${photo.image_base64}`}
+                  src={`${process.env.REACT_APP_BACKEND_URL}${photo.image_url}`}
                   alt={photo.description || photo.category}
                 />
                 <div className="photo-card-overlay flex justify-between items-end">
@@ -0,0 +1,41 @@
+import pytest
+from fastapi import HTTPException
+
+from server import parse_range
+
+SIZE = 100
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-9", (0, 9)),
+    ("bytes=10-", (10, 99)),
+    ("bytes=-10", (90, 99)),
+    ("bytes=-500", (0, 99)),
+    ("bytes=90-500", (90, 99)),
+    ("bytes=99-99", (99, 99)),
+])
+def test_satisfiable_ranges(header, expected):
+    assert parse_range(header, SIZE) == expected
+
+
+@pytest.mark.parametrize("header", [
+    "items=0-9",
+    "bytes=0-9,20-29",
+    "bytes=a-b",
+    "bytes=-",
+])
+def test_ranges_to_ignore(header):
+    assert parse_range(header, SIZE) is None
+
+
+@pytest.mark.parametrize("header", [
+    "bytes=100-",
+    "bytes=50-10",
+    "bytes=-0",
+])
+def test_unsatisfiable_ranges_are_a_416(header):
+    with pytest.raises(HTTPException) as error:
+        parse_range(header, SIZE)
+
+    assert error.value.status_code == 416
+    assert error.value.headers["Content-Range"] == f"bytes */{SIZE}"
@@ -0,0 +1,112 @@
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+from message_store import BUCKET_COLLECTION, BucketMessageStore, conversation_id
+
+pytestmark = pytest.mark.anyio
+
+ALICE, BOB, CAROL = "alice", "bob", "carol"
+
+
+def at(second):
+    return f"2026-01-01T00:00:{second:02d}+00:00"
+
+
+def message(second, sender=ALICE, receiver=BOB):
+    return {
+        "id": f"m{second:02d}",
+        "conversation_id": conversation_id(sender, receiver),
+        "sender_id": sender,
+        "receiver_id": receiver,
+        "content": f"message {second}",
+        "message_type": "text",
+        "created_at": at(second),
+        "is_read": False,
+    }
+
+
+@pytest.fixture
+def db():
+    return AsyncMongoMockClient()["friendsnap_test"]
+
+
+@pytest.fixture
+def store(db):
+    return BucketMessageStore(db, bucket_size=3)
+
+
+async def test_conversation_id_is_symmetric():
+    assert conversation_id(ALICE, BOB) == conversation_id(BOB, ALICE)
+
+
+async def test_full_buckets_roll_over(db, store):
+    for second in range(1, 8):
+        await store.insert(message(second))
+
+    buckets = await db[BUCKET_COLLECTION].find({}, {"_id": 0, "count": 1}).to_list(None)
+    assert sorted(b["count"] for b in buckets) == [1, 3, 3]
+
+
+async def test_pages_span_buckets_newest_first(store):
+    for second in range(1, 8):
+        await store.insert(message(second))
+    conversation = conversation_id(ALICE, BOB)
+
+    first = await store.page(conversation, 5)
+    assert [m["id"] for m in first] == ["m07", "m06", "m05", "m04", "m03"]
+
+    rest = await store.page(conversation, 5, before=(first[-1]["created_at"], first[-1]["id"]))
+    assert [m["id"] for m in rest] == ["m02", "m01"]
+
+
+async def test_find(store):
+    for second in range(1, 5):
+        await store.insert(message(second))
+
+    assert (await store.find(conversation_id(ALICE, BOB), "m04"))["content"] == "message 4"
+    assert await store.find(conversation_id(ALICE, BOB), "missing") is None
+
+
+async def test_changes_include_new_and_read_messages(store):
+    for second in range(1, 5):
+        await store.insert(message(second))
+    conversation = conversation_id(ALICE, BOB)
+
+    assert [m["id"] for m in await store.changes(conversation, at(2))] == ["m03", "m04"]
+
+    await store.mark_read(BOB, ALICE, at(10))
+    changed = await store.changes(conversation, at(4))
+    assert [m["id"] for m in changed] == ["m01", "m02", "m03", "m04"]
+    assert all(m["is_read"] and m["read_at"] == at(10) for m in changed)
+    assert await store.changes(conversation, at(10)) == []
+
+
+async def test_mark_read_only_marks_the_partners_messages_once(store):
+    await store.insert(message(1))
+    await store.insert(message(2, sender=BOB, receiver=ALICE))
+    for second in range(3, 6):
+        await store.insert(message(second))
+
+    assert await store.mark_read(BOB, ALICE, at(10)) == 4
+    assert await store.mark_read(BOB, ALICE, at(11)) == 0
+
+    mine = await store.find(conversation_id(ALICE, BOB), "m02")
+    assert not mine["is_read"]
+
+
+async def test_mark_all_read_stops_at_read_at(store):
+    for second in range(1, 4):
+        await store.insert(message(second))
+    await store.insert(message(4, sender=CAROL, receiver=BOB))
+    await store.insert(message(9, sender=CAROL, receiver=BOB))
+
+    assert await store.mark_all_read(BOB, None, at(5)) == {ALICE: 3, CAROL: 1}
+    assert not (await store.find(conversation_id(BOB, CAROL), "m09"))["is_read"]
+
+
+async def test_mark_all_read_for_some_partners(store):
+    await store.insert(message(1))
+    await store.insert(message(2, sender=CAROL, receiver=BOB))
+
+    assert await store.mark_all_read(BOB, [CAROL], at(5)) == {CAROL: 1}
+    assert not (await store.find(conversation_id(ALICE, BOB), "m01"))["is_read"]
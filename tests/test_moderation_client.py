@@ -0,0 +1,149 @@
+import asyncio
+
+import pytest
+
+from moderation_client import CLOSED, HALF_OPEN, OPEN, CircuitOpen, ModerationClient
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeModel:
+    """Stands in for the model call: counts calls, can fail or wait for a gate"""
+
+    def __init__(self):
+        self.calls = 0
+        self.fail = False
+        self.gate = None
+
+    async def __call__(self, image_base64: str) -> dict:
+        self.calls += 1
+        if self.gate is not None:
+            await self.gate.wait()
+        if self.fail:
+            raise RuntimeError("provider down")
+        return {"tags": [image_base64]}
+
+
+async def fail_calls(client, n):
+    for i in range(n):
+        with pytest.raises(RuntimeError):
+            await client.analyze(f"image-{i}")
+
+
+async def test_stays_closed_below_min_calls():
+    model = FakeModel()
+    model.fail = True
+    client = ModerationClient(model, min_calls=3, cooldown=60)
+
+    await fail_calls(client, 2)
+
+    assert client.state == CLOSED
+
+
+async def test_opens_after_min_calls_failures_and_short_circuits():
+    model = FakeModel()
+    model.fail = True
+    client = ModerationClient(model, min_calls=3, cooldown=60)
+
+    await fail_calls(client, 3)
+    assert client.state == OPEN
+
+    with pytest.raises(CircuitOpen):
+        await client.analyze("another")
+    assert model.calls == 3
+    assert client.get_stats()["short_circuited"] == 1
+
+
+async def test_stays_closed_below_error_rate():
+    model = FakeModel()
+    client = ModerationClient(model, min_calls=4, error_rate=0.5, cooldown=60)
+
+    await client.analyze("ok-1")
+    await client.analyze("ok-2")
+    await client.analyze("ok-3")
+    model.fail = True
+    await fail_calls(client, 1)
+
+    assert client.state == CLOSED
+
+
+async def test_half_open_lets_one_probe_through_and_closes_on_success():
+    model = FakeModel()
+    model.fail = True
+    client = ModerationClient(model, min_calls=2, cooldown=0.01)
+    await fail_calls(client, 2)
+    await asyncio.sleep(0.02)
+
+    model.fail = False
+    model.gate = asyncio.Event()
+    probe = asyncio.ensure_future(client.analyze("probe"))
+    await asyncio.sleep(0)
+    assert client.state == HALF_OPEN
+    with pytest.raises(CircuitOpen):
+        await client.analyze("while probing")
+
+    model.gate.set()
+    assert await probe == {"tags": ["probe"]}
+    assert client.state == CLOSED
+    assert await client.analyze("after") == {"tags": ["after"]}
+
+
+async def test_failed_probe_opens_again():
+    model = FakeModel()
+    model.fail = True
+    client = ModerationClient(model, min_calls=2, cooldown=0.01)
+    await fail_calls(client, 2)
+    await asyncio.sleep(0.02)
+
+    with pytest.raises(RuntimeError):
+        await client.analyze("probe")
+
+    assert client.state == OPEN
+    with pytest.raises(CircuitOpen):
+        await client.analyze("too soon")
+    assert client.get_stats()["opened"] == 2
+
+
+async def test_timeout_counts_as_failure():
+    model = FakeModel()
+    model.gate = asyncio.Event()
+    client = ModerationClient(model, timeout=0.01, min_calls=1, cooldown=60)
+
+    with pytest.raises(asyncio.TimeoutError):
+        await client.analyze("hangs")
+
+    assert client.get_stats()["timeouts"] == 1
+    assert client.state == OPEN
+
+
+async def test_coalesces_identical_calls():
+    model = FakeModel()
+    model.gate = asyncio.Event()
+    client = ModerationClient(model)
+
+    callers = [asyncio.ensure_future(client.analyze("same")) for _ in range(3)]
+    await asyncio.sleep(0)
+    model.gate.set()
+    results = await asyncio.gather(*callers)
+
+    assert results == [{"tags": ["same"]}] * 3
+    assert model.calls == 1
+    assert client.get_stats()["coalesced"] == 2
+    assert client.get_stats()["in_flight"] == 0
+
+
+async def test_cancelled_caller_does_not_cancel_shared_call():
+    model = FakeModel()
+    model.gate = asyncio.Event()
+    client = ModerationClient(model)
+
+    first = asyncio.ensure_future(client.analyze("same"))
+    second = asyncio.ensure_future(client.analyze("same"))
+    await asyncio.sleep(0)
+    first.cancel()
+    await asyncio.sleep(0)
+    model.gate.set()
+
+    assert await second == {"tags": ["same"]}
+    assert first.cancelled()
+    assert model.calls == 1
@@ -0,0 +1,55 @@
+import base64
+
+import pytest
+from fastapi import HTTPException
+from fastapi.responses import Response
+
+from server import NEXT_CURSOR_HEADER, before_cursor, decode_cursor, encode_cursor, set_next_cursor
+
+DOC = {"id": "photo-2", "created_at": "2026-01-01T00:00:02+00:00"}
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor(DOC)
+
+    assert decode_cursor(cursor) == (DOC["created_at"], DOC["id"])
+
+
+def test_cursor_is_url_safe():
+    cursor = encode_cursor({"id": "??>>", "created_at": "~~~"})
+
+    assert set(cursor) <= set("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_=")
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!",
+    base64.urlsafe_b64encode(b"not json").decode(),
+    base64.urlsafe_b64encode(b'{"created_at": "x"}').decode(),
+    base64.urlsafe_b64encode(b'["only one"]').decode(),
+    "é",
+])
+def test_bad_cursor_is_a_400(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_cursor(cursor)
+
+    assert error.value.status_code == 400
+
+
+def test_before_cursor_selects_strictly_older_documents():
+    assert before_cursor(None) == {}
+    assert before_cursor(encode_cursor(DOC)) == {"$or": [
+        {"created_at": {"$lt": DOC["created_at"]}},
+        {"created_at": DOC["created_at"], "id": {"$lt": DOC["id"]}},
+    ]}
+
+
+def test_next_cursor_only_after_a_full_page():
+    page = [{"id": "photo-3", "created_at": "2026-01-01T00:00:03+00:00"}, DOC]
+
+    response = Response()
+    set_next_cursor(response, page, limit=2)
+    assert decode_cursor(response.headers[NEXT_CURSOR_HEADER]) == (DOC["created_at"], DOC["id"])
+
+    response = Response()
+    set_next_cursor(response, page, limit=3)
+    assert NEXT_CURSOR_HEADER not in response.headers
@@ -0,0 +1,63 @@
+import math
+
+import similarity
+from similarity import CATEGORY_WEIGHT, MIN_IDF, TAG_WEIGHT, score_users
+
+
+def postings(**terms_by_user):
+    return [{"user_id": uid, "term": term} for uid, terms in terms_by_user.items() for term in terms]
+
+
+def test_scores_shared_tags_and_categories_best_first():
+    ranked = score_users(postings(
+        a=["tag:dog", "category:art"],
+        b=["tag:dog", "category:art"],
+        c=["tag:dog"],
+        d=["tag:cat"],
+    ))
+
+    assert ranked["a"] == [("b", TAG_WEIGHT + CATEGORY_WEIGHT), ("c", TAG_WEIGHT)]
+    assert "d" not in ranked
+
+
+def test_duplicate_postings_count_once():
+    ranked = score_users(postings(a=["tag:dog", "tag:dog"], b=["tag:dog"]))
+
+    assert ranked["a"] == [("b", TAG_WEIGHT)]
+
+
+def test_keeps_top_k():
+    ranked = score_users(postings(
+        a=["tag:dog", "tag:cat", "tag:sea"],
+        b=["tag:dog", "tag:cat", "tag:sea"],
+        c=["tag:dog", "tag:cat"],
+        d=["tag:dog"],
+    ), top_k=2)
+
+    assert [uid for uid, _ in ranked["a"]] == ["b", "c"]
+
+
+def test_needs_two_users():
+    assert score_users(postings(a=["tag:dog"])) == {}
+    assert score_users([]) == {}
+
+
+def test_tfidf_barely_counts_ubiquitous_terms():
+    ranked = score_users(postings(
+        a=["tag:dog", "tag:rare"],
+        b=["tag:dog", "tag:rare"],
+        c=["tag:dog"],
+    ), tfidf=True)
+
+    rare_idf = math.log((1 + 3) / (1 + 2))
+    assert ranked["a"][0] == ("b", round(TAG_WEIGHT * (MIN_IDF + rare_idf), 2))
+    assert ranked["a"][1] == ("c", round(TAG_WEIGHT * MIN_IDF, 2))
+
+
+def test_blocks_give_the_same_result(monkeypatch):
+    data = postings(**{f"u{i}": [f"tag:t{i % 3}", f"category:c{i % 2}"] for i in range(7)})
+    expected = score_users(data)
+
+    monkeypatch.setattr(similarity, "BLOCK_SIZE", 2)
+
+    assert score_users(data) == expected